@@ -0,0 +1,314 @@
+# Controlling ACME++ power meters
+#
+# An ACME++ switches its relay on receiving a single byte UDP packet: '\x01'
+#   for on and '\x02' for off. Nothing comes back, so the only way to be sure
+#   is to keep resending.
+#
+# Devices with acknowledgement support also accept a sequence number after the
+#   command byte, and a read command '\x03'. They reply to each with three
+#   bytes: the command byte with the top bit set, the same sequence number,
+#   and the relay state (1 on, 0 off). In ack mode only the outstanding
+#   request is retransmitted, until its reply arrives, and the relay state is
+#   read back every refresh_interval instead of being blindly resent.
+#
+# ActuatorManager owns the UDP sockets for every ACME++ in the process.
+#   Devices queue their packets with it as they come due, and it sends
+#   everything queued in one pass over the shared sockets, so commanding a
+#   whole building doesn't take a socket per device.
+
+import time
+import random
+import socket
+from threading import Thread
+
+import logpipe
+import metrics
+
+COMMAND_ON = 0x01
+COMMAND_OFF = 0x02
+COMMAND_READ = 0x03
+REPLY = 0x80
+
+SENT = metrics.Counter('acmepp_packets_sent_total', 'UDP packets sent to ACME++s')
+SEND_FAILURES = metrics.Counter('acmepp_send_failures_total',
+        'UDP packets to ACME++s that could not be sent')
+SUPPRESSED = metrics.Counter('acmepp_suppressed_total',
+        'ACME++ transmissions held back by rate limiting')
+RETRANSMITS = metrics.Counter('acmepp_retransmits_total',
+        'Requests resent for lack of a reply in ack mode')
+
+log = logpipe.get('acmepp')
+
+
+class ActuatorManager ():
+    # number of UDP sockets shared between all devices
+    SOCKETS = 1
+
+    def __init__ (self, post_action=None, ack=False):
+        # post_action is called with a record for GATD whenever a device
+        #   changes state. ack selects the acknowledged protocol
+        self.post_action = post_action
+        self.ack = ack
+        self.sockets = [socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                for index in range(self.SOCKETS)]
+        self.devices = []
+        # (packed address, port): [devices], for matching up replies. Rooms
+        #   left on the same default devices share an address
+        self.by_addr = {}
+        self.pending = []
+
+        # replies come back to the port requests are sent from
+        if ack:
+            for s in self.sockets:
+                s.bind(('::', 0))
+
+    def device (self, ipv6_addr, port, name, location):
+        # create an ACME++ whose packets go through this manager
+        s = self.sockets[len(self.devices) % len(self.sockets)]
+        device = ACMEpp(self, s, ipv6_addr, port, name, location)
+        self.devices.append(device)
+        self.by_addr.setdefault(_addr_key(ipv6_addr, port), []).append(device)
+        return device
+
+    def remove (self, device):
+        # forget a device that is no longer used. Packets it has already
+        #   queued still go out
+        self.devices.remove(device)
+        key = _addr_key(device.addr, device.port)
+        devices = self.by_addr.get(key, [])
+        if device in devices:
+            devices.remove(device)
+        if len(devices) == 0:
+            self.by_addr.pop(key, None)
+
+    def start_receiving (self, message_queue):
+        # push replies from devices into message_queue as ['ack', (sender,
+        #   data), recv_time]. They should be handed back to receive() on the
+        #   thread that owns the devices
+        if self.ack:
+            for s in self.sockets:
+                ReplyThread(s, message_queue)
+
+    def receive (self, sender, data, now):
+        # handle a reply, returns the devices it answered. Each device at the
+        #   sender's address checks whether the reply is to its own request
+        try:
+            devices = self.by_addr.get(_addr_key(sender[0], sender[1]), ())
+        except socket.error:
+            return []
+        return [device for device in devices if device.on_reply(data, now)]
+
+    def send (self, s, data, addr):
+        # queue a packet, it goes out on the next flush()
+        self.pending.append((s, data, addr))
+
+    def flush (self):
+        # send every queued packet. Returns the number sent
+        pending = self.pending
+        if len(pending) == 0:
+            return 0
+        self.pending = []
+
+        sent = 0
+        for (s, data, addr) in pending:
+            try:
+                s.sendto(data, addr)
+                sent += 1
+            except socket.error, e:
+                SEND_FAILURES.inc()
+                # a lost packet gets made up by the retries
+                log.warning("Failure to send to ACME++ %s: %s", addr[0], e)
+        SENT.inc(sent)
+        return sent
+
+
+def _addr_key (ipv6_addr, port):
+    # the same address can be written many ways, compare it packed
+    return (socket.inet_pton(socket.AF_INET6, ipv6_addr.split('%')[0]), port)
+
+
+class ReplyThread (Thread):
+
+    def __init__ (self, s, message_queue):
+        super(ReplyThread, self).__init__()
+        self.daemon = True
+        self.s = s
+        self.message_queue = message_queue
+        self.start()
+
+    def run (self):
+        while True:
+            try:
+                (data, sender) = self.s.recvfrom(64)
+            except socket.error:
+                continue
+            self.message_queue.put(['ack', (sender, data), time.time()])
+
+
+class ACMEpp ():
+    # after a state change the command is resent at a doubling interval,
+    #   starting from the minimum, until the interval passes the maximum. The
+    #   state is then taken as confirmed and only refreshed every
+    #   refresh_interval seconds
+    transmission_limit_min = 0.25
+    transmission_limit_max = 10.0
+    refresh_interval = 5*60.0
+
+    def __init__ (self, manager, s, ipv6_addr, port, name, location):
+        self.manager = manager
+        self.s = s
+        self.addr = ipv6_addr
+        self.port = port
+        self.name = name
+        self.location = location
+        self.last_post_time = 0
+        self.transmission_limit = self.transmission_limit_min
+
+        # the state the device is being commanded to, None until the first
+        #   command. The device can't be asked for its real state, so the
+        #   commanded state counts as confirmed once the fast retries are done
+        self.on = None
+        self.confirmed = None
+        # whether the new state still needs to be logged to GATD
+        self.changed = False
+
+        # ack mode: the request waiting for a reply, if any. Sequences start
+        #   anywhere, so devices sharing an address rarely collide
+        self.sequence = random.randrange(256)
+        self.outstanding = None
+
+    def setOn (self):
+        self._set(True)
+
+    def setOff (self):
+        self._set(False)
+
+    def restore (self, on, now):
+        # take on a state commanded before a restart without sending it again.
+        #   The first refresh is spread over refresh_interval, so restarting
+        #   doesn't send to every device at once
+        self.on = on
+        self.confirmed = on
+        self.changed = False
+        self.outstanding = None
+        self.transmission_limit = self.refresh_interval
+        self.last_post_time = now - random.uniform(0, self.refresh_interval)
+
+    def service (self, now):
+        # queue the current state for sending if rate-limiting says its okay.
+        #   Returns the time at which the next transmission is due, or None
+        if self.on is None:
+            return None
+        if self.manager.ack:
+            return self._service_ack(now)
+
+        if (self._should_transmit(now)):
+            # only log state changes, not retries and refreshes
+            if self.changed:
+                self._post_action('on' if self.on else 'off')
+                self.changed = False
+            if self.on:
+                self.manager.send(self.s, '\x01'.encode(), (self.addr, self.port))
+            else:
+                self.manager.send(self.s, '\x02'.encode(), (self.addr, self.port))
+
+        return self.last_post_time + self.transmission_limit
+
+    def _set (self, on):
+        # commanding the state the device is already in changes nothing
+        if on == self.on:
+            return
+
+        self.on = on
+        self.changed = True
+        self.transmission_limit = self.transmission_limit_min
+        # any reply to an earlier request no longer matters
+        self.outstanding = None
+        self.service(time.time())
+
+    def on_reply (self, data, now):
+        # ack mode: handle a reply from the device. Returns whether it
+        #   answered the outstanding request
+        if len(data) < 3 or self.outstanding is None:
+            return False
+        if ord(data[0]) != (REPLY | self.outstanding) or ord(data[1]) != self.sequence:
+            # a late reply to an old request, or to another device at the same
+            #   address
+            return False
+
+        self.outstanding = None
+        self.confirmed = ord(data[2]) == 1
+        self.last_post_time = now
+        if self.confirmed == self.on:
+            self.transmission_limit = self.transmission_limit_min
+        else:
+            # the relay didn't move, stuck or refusing. That counts as a
+            #   failed attempt, and the next one waits out the backoff
+            self.transmission_limit = min(2*self.transmission_limit, self.transmission_limit_max)
+        return True
+
+    def _service_ack (self, now):
+        if self.outstanding is None:
+            if self.confirmed != self.on:
+                # the relay isn't known to be in the right state. A new
+                #   command goes out at once, a retry after a reply with the
+                #   wrong state once the backoff allows
+                if not self.changed and now - self.last_post_time < self.transmission_limit:
+                    SUPPRESSED.inc()
+                    return self.last_post_time + self.transmission_limit
+                if self.changed:
+                    self._post_action('on' if self.on else 'off')
+                    self.changed = False
+                self._request(COMMAND_ON if self.on else COMMAND_OFF, now)
+            elif now - self.last_post_time >= self.refresh_interval:
+                # check that nothing else has flipped the relay
+                self.transmission_limit = self.transmission_limit_min
+                self._request(COMMAND_READ, now)
+            else:
+                return self.last_post_time + self.refresh_interval
+        elif now - self.last_post_time >= self.transmission_limit:
+            # no reply yet, retransmit
+            RETRANSMITS.inc()
+            self.transmission_limit = min(2*self.transmission_limit, self.transmission_limit_max)
+            self.last_post_time = now
+            self._send_outstanding()
+
+        return self.last_post_time + self.transmission_limit
+
+    def _request (self, command, now):
+        self.sequence = (self.sequence + 1) % 256
+        self.outstanding = command
+        self.last_post_time = now
+        self._send_outstanding()
+
+    def _send_outstanding (self):
+        self.manager.send(self.s, chr(self.outstanding) + chr(self.sequence),
+                (self.addr, self.port))
+
+    def _should_transmit (self, now):
+        # rate-limiting packet transmissions
+        if (now - self.last_post_time) < self.transmission_limit:
+            SUPPRESSED.inc()
+            return False
+        self.last_post_time = now
+
+        # exponential backoff, then a slow refresh
+        if self.transmission_limit < self.transmission_limit_max:
+            self.transmission_limit = min(2*self.transmission_limit, self.transmission_limit_max)
+        else:
+            self.transmission_limit = self.refresh_interval
+            self.confirmed = self.on
+
+        return True
+
+    def _post_action (self, action):
+        if self.manager.post_action is None:
+            return
+        data = {
+                'action': action,
+                'acmepp_addr': self.addr,
+                'acmepp_port': self.port,
+                'name': self.name,
+                'location_str': self.location
+                }
+        self.manager.post_action(data)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Throughput benchmark for the light control decision logic
+#
+# Generates synthetic building scale workloads and replays them through the
+#   decision logic as fast as possible, reporting events per second, the
+#   p50/p99 time taken per event, and memory used per room.
+
+import os
+import sys
+import time
+import array
+import resource
+
+import eventlog
+import roomcontrol
+from replay import Replayer
+
+USAGE = """
+Benchmarks the light control decision logic on synthetic workloads
+
+Usage:
+    bench.py [--rooms=N,...] [--hours=H] [--interval=S] [--events=<file>]
+
+Options:
+    --rooms=        comma separated room counts to run, default 10,100,1000
+    --hours=        hours of traffic to generate for each run, default 24
+    --interval=     seconds between presence packets from a room, default 60
+    --events=       also benchmark a recorded events file
+"""
+
+
+def get_option (name, default):
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def resident_bytes ():
+    # current resident memory, falling back to the peak where /proc isn't
+    #   available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile (values, fraction):
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run (name, events):
+    # replays events, timing each one. Events are materialized first so their
+    #   generation isn't counted
+    events = list(events)
+    replayer = Replayer()
+    latencies = array.array('d')
+    timer = time.time
+
+    start = timer()
+    for (recv_time, data_type, pkt) in events:
+        before = timer()
+        replayer.feed(recv_time, data_type, pkt)
+        latencies.append(timer() - before)
+    elapsed = timer() - start
+
+    latencies = sorted(latencies)
+    print(name)
+    print("    rooms:      " + str(len(replayer.rooms)))
+    print("    events:     " + str(len(events)))
+    print("    commands:   " + str(replayer.commands))
+    print("    events/sec: " + "%.0f" % (len(events) / elapsed if elapsed > 0 else 0))
+    print("    p50:        " + "%.2f us" % (percentile(latencies, 0.50) * 1e6))
+    print("    p99:        " + "%.2f us" % (percentile(latencies, 0.99) * 1e6))
+
+def room_memory (count):
+    # bytes of memory used per RoomController
+    before = resident_bytes()
+    rooms = [roomcontrol.RoomController('Synthetic|Building|' + str(index))
+            for index in range(count)]
+    after = resident_bytes()
+    return (after - before) / float(len(rooms))
+
+def main ():
+    if '--help' in sys.argv:
+        print(USAGE)
+        sys.exit(0)
+
+    room_counts = [int(count) for count in get_option('rooms', '10,100,1000').split(',')]
+    hours = float(get_option('hours', '24'))
+    interval = float(get_option('interval', '60'))
+    events_file = get_option('events', None)
+
+    print("Memory per room: " + "%.0f bytes" % room_memory(100000))
+
+    for rooms in room_counts:
+        events = eventlog.synthetic_events(rooms, hours*3600, presence_interval=interval)
+        run("Synthetic, " + str(rooms) + " rooms, " + str(hours) + " hours", events)
+
+    if events_file is not None:
+        run("Recorded, " + os.path.basename(events_file),
+                eventlog.read_events(events_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Room and device configuration
+#
+# One json file describes every room a controller runs, for example:
+#
+#   {
+#       "profiles": {"presence": "hsYQx8blbd", "button": "9YWtcF3MFW",
+#                    "command": "MUs0XwOiyp", "light": "UbkhN72jvp"},
+#       "defaults": {
+#           "devices": {"lights": ["2607:f018:800:10f:c298:e541:4310:1", 47652],
+#                       "panel": ["2607:f018:800:10f:c298:e541:4310:8", 47652]},
+#           "buttons": [["b827eb0a2b8f", 25]],
+#           "panel_people": [{"samkuo": "Ye-Sheng Kuo"}],
+#           "absence_timeout": 600,
+#           "panel_timeout": 1800,
+#           "adaptive_timeout": false
+#       },
+#       "rooms": {
+#           "University|Building|Room": {
+#               "devices": {"lights": ["2607:f018:800:10f:c298:e541:4310:2", 47652]},
+#               "panel_people": ["samkuo", "bradjc"]
+#           }
+#       }
+#   }
+#
+# Every part is optional. Rooms take anything they leave out from defaults,
+#   device by device, and defaults take anything they leave out from the
+#   values built in here. Timeouts are in seconds. adaptive_timeout has
+#   absence_timeout learned per hour of the week from how often the lights
+#   are wanted back right after going off, see occupancy.py.
+#
+# load() checks the whole file before returning, so a bad edit is reported
+#   rather than half applied. Two rooms given the same device, say by both
+#   taking it from defaults, are an error. Rooms with the same buttons or
+#   people share a single compiled table.
+
+import json
+import socket
+from collections import namedtuple
+
+import roomcontrol
+
+DEVICE_NAMES = ('lights', 'panel')
+
+DEFAULT_PROFILES = {
+        'presence': 'hsYQx8blbd',
+        'button': '9YWtcF3MFW',
+        'command': 'MUs0XwOiyp',
+        'light': 'UbkhN72jvp',
+        }
+# name: (ipv6 address, port)
+DEFAULT_DEVICES = {
+        'lights': ('2607:f018:800:10f:c298:e541:4310:1', 47652),
+        'panel': ('2607:f018:800:10f:c298:e541:4310:8', 47652),
+        }
+
+ROOM_KEYS = ('devices', 'buttons', 'panel_people', 'absence_timeout', 'panel_timeout',
+        'adaptive_timeout')
+
+Profiles = namedtuple('Profiles', ['presence', 'button', 'command', 'light'])
+
+# devices is {name: (ipv6 address, port)}, buttons a frozenset of (device_id,
+#   button_id) and likes a roomcontrol.index_likes() index
+RoomConfig = namedtuple('RoomConfig',
+        ['devices', 'buttons', 'likes', 'absence_timeout', 'panel_timeout',
+         'adaptive_timeout'])
+
+
+class ConfigError (Exception):
+    pass
+
+
+class Config (namedtuple('Config', ['profiles', 'defaults', 'rooms'])):
+    # profiles is a Profiles, defaults the RoomConfig for rooms not listed and
+    #   rooms is {location: RoomConfig}
+
+    def room (self, location):
+        return self.rooms.get(location, self.defaults)
+
+
+def load (path=None):
+    # read and check a configuration file. Returns the built in configuration
+    #   if path is None
+    data = {}
+    if path is not None:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except IOError, e:
+            raise ConfigError(str(e))
+        except ValueError, e:
+            raise ConfigError(path + ": " + str(e))
+    return _Compiler().config(data)
+
+
+def shared_devices (rooms):
+    # the devices used by more than one of rooms, {location: RoomConfig}, as
+    #   {(ipv6 address, port): [(location, device name), ...]}
+    users = {}
+    for (location, room_config) in rooms.items():
+        for (name, (addr, port)) in room_config.devices.items():
+            key = (socket.inet_pton(socket.AF_INET6, addr.split('%')[0]), port)
+            users.setdefault(key, []).append((location, name))
+    shared = {}
+    for (key, devices) in users.items():
+        if len(devices) > 1:
+            addr = socket.inet_ntop(socket.AF_INET6, key[0])
+            shared[(addr, key[1])] = devices
+    return shared
+
+
+class _Compiler ():
+
+    def __init__ (self):
+        # compiled tables, so rooms with equal settings share them
+        self.buttons = {}
+        self.likes = {}
+
+    def config (self, data):
+        _keys(data, 'config', ('profiles', 'defaults', 'rooms'))
+
+        profiles = dict(DEFAULT_PROFILES)
+        _keys(data.get('profiles', {}), 'profiles', Profiles._fields)
+        for (name, profile_id) in data.get('profiles', {}).items():
+            _check(isinstance(profile_id, basestring), 'profiles.' + name,
+                    "expected a profile id")
+            profiles[str(name)] = str(profile_id)
+
+        base = {
+                'devices': DEFAULT_DEVICES,
+                'buttons': roomcontrol.BUTTONS,
+                'panel_people': roomcontrol.PANEL_PEOPLE,
+                'absence_timeout': roomcontrol.ABSENCE_TIMEOUT,
+                'panel_timeout': roomcontrol.PANEL_TIMEOUT,
+                'adaptive_timeout': False,
+                }
+        base = self._merge(base, data.get('defaults', {}), 'defaults')
+        defaults = self._room(base, 'defaults')
+
+        rooms = {}
+        _check(isinstance(data.get('rooms', {}), dict), 'rooms', "expected an object")
+        for (location, settings) in data.get('rooms', {}).items():
+            where = 'rooms.' + location
+            rooms[location] = self._room(self._merge(base, settings, where), where)
+
+        # rooms sharing a device would fight over it
+        for users in shared_devices(rooms).values():
+            ((location, name), (other, other_name)) = sorted(users)[:2]
+            raise ConfigError('rooms.' + other + '.devices.' + other_name +
+                    ": same device as rooms." + location + '.devices.' + name)
+
+        return Config(Profiles(**profiles), defaults, rooms)
+
+    def _merge (self, base, settings, where):
+        # settings layered over base. Devices are merged one by one
+        _keys(settings, where, ROOM_KEYS)
+        merged = dict(base)
+        merged.update(settings)
+        if 'devices' in settings:
+            _keys(settings['devices'], where + '.devices', DEVICE_NAMES)
+            merged['devices'] = dict(base['devices'])
+            merged['devices'].update(settings['devices'])
+        return merged
+
+    def _room (self, settings, where):
+        devices = {}
+        for (name, value) in settings['devices'].items():
+            devices[name] = _device(value, where + '.devices.' + name)
+
+        return RoomConfig(devices,
+                self._buttons(settings['buttons'], where + '.buttons'),
+                self._likes(settings['panel_people'], where + '.panel_people'),
+                _timeout(settings['absence_timeout'], where + '.absence_timeout'),
+                _timeout(settings['panel_timeout'], where + '.panel_timeout'),
+                _flag(settings['adaptive_timeout'], where + '.adaptive_timeout'))
+
+    def _buttons (self, value, where):
+        _check(isinstance(value, (list, tuple)), where, "expected a list")
+        buttons = []
+        for button in value:
+            _check(isinstance(button, (list, tuple)) and len(button) == 2 and
+                    isinstance(button[0], basestring) and _is_int(button[1]),
+                    where, "expected [device_id, button_id] pairs")
+            buttons.append((str(button[0]), button[1]))
+        buttons = frozenset(buttons)
+        return self.buttons.setdefault(buttons, buttons)
+
+    def _likes (self, value, where):
+        _check(isinstance(value, (list, tuple)), where, "expected a list")
+        people = set()
+        for entry in value:
+            _check(isinstance(entry, basestring) or (isinstance(entry, dict) and
+                    all(isinstance(key, basestring) for key in entry)),
+                    where, "expected uniqnames or {uniqname: name} objects")
+            people.update(roomcontrol.person_ids(entry))
+        people = frozenset(people)
+        if people not in self.likes:
+            self.likes[people] = roomcontrol.index_likes({'panel': people})
+        return self.likes[people]
+
+
+def _check (condition, where, message):
+    if not condition:
+        raise ConfigError(where + ": " + message)
+
+def _keys (value, where, allowed):
+    # value must be an object with no keys other than allowed
+    _check(isinstance(value, dict), where, "expected an object")
+    for key in value:
+        _check(key in allowed, where, "unknown setting '" + key + "'")
+
+def _is_int (value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _device (value, where):
+    _check(isinstance(value, (list, tuple)) and len(value) == 2 and
+            isinstance(value[0], basestring) and _is_int(value[1]),
+            where, "expected [ipv6 address, port]")
+    (addr, port) = value
+    try:
+        socket.inet_pton(socket.AF_INET6, addr.split('%')[0])
+    except (socket.error, UnicodeError):
+        raise ConfigError(where + ": not an IPv6 address: " + addr)
+    _check(0 < port < 65536, where, "port out of range")
+    return (str(addr), port)
+
+def _timeout (value, where):
+    _check(isinstance(value, (int, long, float)) and not isinstance(value, bool) and value > 0,
+            where, "expected a positive number of seconds")
+    return value
+
+def _flag (value, where):
+    _check(isinstance(value, bool), where, "expected true or false")
+    return value
@@ -0,0 +1,214 @@
+# Recording and generating streams of GATD events
+#
+# Events are the [data_type, pkt, recv_time] lists the ingest.py transports
+#   push into the message queue, stored one per line as compact json with the
+#   time they were received first:
+#       [recv_time, data_type, pkt]
+#   Files ending in .gz are gzip compressed.
+#
+# Data recorded by GATD itself, from before there were recordings, can be
+#   read too. GATD exports each profile's records as a json array, or as one
+#   json object per line, each with the profile_id it was posted to and the
+#   time GATD got it in milliseconds. read_inputs() takes any mix of
+#   recordings and exports, tells them apart by their first line, and merges
+#   them into one stream in time order.
+
+import gzip
+import json
+import time
+import heapq
+import random
+import itertools
+import threading
+
+import config
+import roomcontrol
+
+# the GATD profiles that carry events for the controllers
+EVENT_TYPES = ('presence', 'button', 'command')
+
+# seconds between flushes of a recording to disk
+FLUSH_INTERVAL = 1.0
+
+
+def _open (path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def read_events (path):
+    # yields (recv_time, data_type, pkt) for every event in a recording. A
+    #   recording cut short by a crash ends at its last whole line
+    with _open(path, 'rb') as f:
+        lines = iter(f)
+        while True:
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            except (IOError, EOFError):
+                # a compressed recording that was never closed
+                return
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                (recv_time, data_type, pkt) = json.loads(line)
+            except ValueError:
+                # cut off by a crash
+                continue
+            yield (recv_time, data_type, pkt)
+
+def read_gatd_export (path, profiles=config.DEFAULT_PROFILES):
+    # yields (recv_time, data_type, pkt) for the records of a GATD export in
+    #   time order. profiles maps data types to profile ids, as in
+    #   config.DEFAULT_PROFILES. Records of other profiles are skipped
+    types = dict((profiles[data_type], data_type) for data_type in EVENT_TYPES)
+    with _open(path, 'rb') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '':
+            return
+        if first == '[':
+            # an array has to be read whole
+            records = [record for record in json.loads(first + f.read())
+                    if isinstance(record, dict)]
+            records.sort(key=lambda record: record.get('time'))
+        else:
+            # one record per line, in the order GATD stored them
+            records = _export_lines(first + f.readline(), f)
+        for pkt in records:
+            data_type = types.get(pkt.get('profile_id'))
+            if data_type is None or not isinstance(pkt.get('time'), (int, long, float)):
+                continue
+            yield (pkt['time'] / 1000.0, data_type, pkt)
+
+def _export_lines (first, f):
+    for line in itertools.chain([first], f):
+        line = line.strip()
+        if line == '':
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict):
+            yield record
+
+def is_recording (path):
+    # whether path is a recording rather than a GATD export
+    with _open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError:
+                # the opening line of a json array
+                return False
+            return (isinstance(value, list) and len(value) == 3 and
+                    isinstance(value[0], (int, long, float)))
+    return True
+
+def read_inputs (paths, profiles=config.DEFAULT_PROFILES):
+    # yields (recv_time, data_type, pkt) from every recording and GATD
+    #   export in paths, merged in time order
+    streams = []
+    for path in paths:
+        if is_recording(path):
+            streams.append(read_events(path))
+        else:
+            streams.append(read_gatd_export(path, profiles))
+    if len(streams) == 1:
+        return streams[0]
+    return heapq.merge(*streams)
+
+def write_events (path, events):
+    # write (recv_time, data_type, pkt) events to a new recording
+    with _open(path, 'wb') as f:
+        for (recv_time, data_type, pkt) in events:
+            f.write(json.dumps([recv_time, data_type, pkt], separators=(',', ':')) + '\n')
+
+
+class Recorder ():
+    # stands in for a message queue, recording every event put into it before
+    #   passing it on
+
+    def __init__ (self, path, message_queue):
+        self.f = _open(path, 'ab')
+        self.message_queue = message_queue
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def put (self, item):
+        (data_type, pkt, recv_time) = item
+        line = json.dumps([recv_time, data_type, pkt], separators=(',', ':')) + '\n'
+        with self.lock:
+            # receivers can still be putting while the process exits
+            if not self.f.closed:
+                self.f.write(line)
+                if recv_time - self.last_flush > FLUSH_INTERVAL:
+                    self.f.flush()
+                    self.last_flush = recv_time
+        self.message_queue.put(item)
+
+    def close (self):
+        # must be called for a compressed recording to be readable to the end
+        with self.lock:
+            self.f.close()
+
+
+def synthetic_events (rooms, duration, presence_interval=60, button_rate=0.5,
+        command_rate=0.1, people=20, panel_people=roomcontrol.PANEL_PEOPLE,
+        start_time=0, seed=0):
+    # yields (recv_time, data_type, pkt) for a building of synthetic rooms, in
+    #   time order
+    #   rooms: number of rooms, named 'Synthetic|Building|<n>'
+    #   duration: seconds of traffic to generate
+    #   presence_interval: seconds between presence packets from each room
+    #   button_rate, command_rate: mean presses and commands per room per day
+    #   people: people per room. panel_people are mixed into the first rooms
+    #
+    # Each room is occupied for a block of the day that varies a little from
+    #   room to room, so the absence and panel timeouts get exercised.
+    rng = random.Random(seed)
+    locations = ['Synthetic|Building|' + str(index) for index in range(rooms)]
+    names = [[location.split('|')[-1] + '-' + str(person) for person in range(people)]
+            for location in locations]
+    for (index, person) in enumerate(panel_people):
+        names[index % rooms].append(person)
+    occupied = [(rng.uniform(7, 10)*3600, rng.uniform(16, 20)*3600) for location in locations]
+
+    (device_id, button_id) = roomcontrol.BUTTONS[0]
+    button_p = button_rate * presence_interval / 86400.0
+    command_p = command_rate * presence_interval / 86400.0
+    commands = ['on', 'off', 'stay_on', 'stay_off', 'resume', 'panel_on', 'panel_off']
+
+    # rooms report in a staggered order within each interval
+    offsets = [rng.uniform(0, presence_interval) for location in locations]
+    order = sorted(range(rooms), key=lambda index: offsets[index])
+
+    tick = start_time
+    while tick < start_time + duration:
+        for index in order:
+            now = tick + offsets[index]
+            location = locations[index]
+            second_of_day = now % 86400
+
+            (arrive, leave) = occupied[index]
+            if arrive <= second_of_day < leave:
+                present = rng.sample(names[index], rng.randint(1, len(names[index])))
+            else:
+                present = []
+            yield (now, 'presence',
+                    {'location_str': location, 'time': now, 'person_list': present})
+
+            if rng.random() < button_p:
+                yield (now, 'button', {'location_str': location, 'time': now,
+                        'device_id': device_id, 'button_id': button_id})
+            if rng.random() < command_p:
+                yield (now, 'command', {'location_str': location, 'time': now,
+                        'light_command': rng.choice(commands)})
+        tick += presence_interval
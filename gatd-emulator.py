@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+# A local stand-in for GATD, for load testing without the real backend
+#
+# Serves the three parts of GATD the controllers use, on the same ports:
+#   8081: POST a json record to /<profile_id>
+#   8082: socket.io (0.9, xhr-polling) stream namespace. Clients emit 'query'
+#         with a dict containing profile_id and get 'data' events for every
+#         matching record
+#   8085: GET /explore/profile/<profile_id> for the values seen for each key
+#
+# It can also generate presence, button and command traffic for any number of
+#   synthetic rooms, and publish every record over UDP or ZeroMQ to test the
+#   other transports of ingest.py. Point the controllers at it with
+#   GATD_HOST=localhost.
+
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import Queue
+from collections import deque
+
+import eventlog
+import ingest
+import localpath
+import scheduler
+
+USAGE = """
+Runs a local GATD emulator
+
+Usage:
+    gatd-emulator.py [options]
+
+Options:
+    --host=             address to listen on, default localhost
+    --port-offset=N     add N to every port, default 0
+    --rooms=N           generate traffic for N synthetic rooms, default 0
+    --interval=S        seconds between presence packets from a room, default 60
+    --speedup=X         generate traffic X times faster than real time
+    --button-rate=R     button presses per room per day, default 0.5
+    --command-rate=R    light commands per room per day, default 0.1
+    --drop-every=S      disconnect every stream client every S seconds, to
+                        test reconnect storms
+    --publish-udp=H:P   also send every record as a json datagram to host H,
+                        port P, for the controllers' udp transport
+    --publish-zmq=P     also publish every record on a ZeroMQ PUB socket on
+                        port P, for the zmq transport (needs pyzmq)
+"""
+
+PRESENCE_PROFILE_ID = 'hsYQx8blbd'
+BUTTON_PROFILE_ID = '9YWtcF3MFW'
+LIGHT_COMMAND_PROFILE_ID = 'MUs0XwOiyp'
+
+POST_PORT = 8081
+STREAM_PORT = 8082
+EXPLORER_PORT = 8085
+
+# packets kept per profile, for queries that resume from a time
+HISTORY = 10000
+# packets buffered for each stream client before the oldest are dropped
+SESSION_BACKLOG = 10000
+# socket.io timings, in seconds
+HEARTBEAT_TIMEOUT = 60
+CLOSE_TIMEOUT = 60
+POLL_DURATION = 20
+# distinct values remembered per key for the explorer
+EXPLORER_VALUES = 10000
+
+
+def get_option (name, default):
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+class Broker ():
+    # routes records posted to a profile to every stream subscribed to it
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        # profile_id: list of (session, endpoint, query)
+        self.subscriptions = {}
+        # profile_id: deque of recent packets
+        self.history = {}
+        # profile_id: {key: {value: count}}
+        self.explorer = {}
+
+        self.published = 0
+        self.delivered = 0
+        # functions called with every record, for the other transports
+        self.sinks = []
+
+    def publish (self, profile_id, pkt):
+        pkt = dict(pkt)
+        pkt['profile_id'] = profile_id
+        pkt['time'] = int(time.time()*1000)
+
+        with self.lock:
+            self.published += 1
+            self.history.setdefault(profile_id, deque(maxlen=HISTORY)).append(pkt)
+            values = self.explorer.setdefault(profile_id, {})
+            for (key, value) in pkt.items():
+                if key == 'time' or not isinstance(value, basestring):
+                    continue
+                counts = values.setdefault(key, {})
+                if value in counts or len(counts) < EXPLORER_VALUES:
+                    counts[value] = counts.get(value, 0) + 1
+            subscriptions = list(self.subscriptions.get(profile_id, []))
+
+        for sink in self.sinks:
+            sink(pkt)
+        for (session, endpoint, query) in subscriptions:
+            if ingest.matches(query, pkt):
+                session.emit(endpoint, 'data', pkt)
+                self.delivered += 1
+
+    def subscribe (self, session, endpoint, query):
+        profile_id = query.get('profile_id')
+        with self.lock:
+            self.subscriptions.setdefault(profile_id, []).append((session, endpoint, query))
+            history = list(self.history.get(profile_id, []))
+
+        # resume from a point in time if asked
+        if isinstance(query.get('time'), (int, long, float)):
+            for pkt in history:
+                if pkt['time'] > query['time'] and ingest.matches(query, pkt):
+                    session.emit(endpoint, 'data', pkt)
+
+    def unsubscribe (self, session):
+        with self.lock:
+            for (profile_id, subscriptions) in self.subscriptions.items():
+                self.subscriptions[profile_id] = [subscription for subscription in subscriptions
+                        if subscription[0] is not session]
+
+    def explore (self, profile_id):
+        with self.lock:
+            values = self.explorer.get(profile_id, {})
+            return dict((key, dict(counts)) for (key, counts) in values.items())
+
+
+class Session ():
+    # one socket.io client connection
+
+    def __init__ (self, broker):
+        self.sid = uuid.uuid4().hex
+        self.broker = broker
+        self.outgoing = scheduler.EventQueue()
+        self.last_seen = time.time()
+        self.closed = False
+        self.send('1::')
+
+    def send (self, packet):
+        if self.outgoing.qsize() >= SESSION_BACKLOG:
+            try:
+                self.outgoing.get(timeout=0)
+            except Queue.Empty:
+                pass
+        self.outgoing.put(packet)
+
+    def emit (self, endpoint, name, *args):
+        self.send('5::' + endpoint + ':' + json.dumps({'name': name, 'args': args}))
+
+    def poll (self):
+        # wait for packets to send the client, returns them framed as a
+        #   socket.io 0.9 payload
+        self.last_seen = time.time()
+        packets = []
+        try:
+            packets.append(self.outgoing.get(timeout=POLL_DURATION))
+            while True:
+                packets.append(self.outgoing.get(timeout=0))
+        except Queue.Empty:
+            pass
+        self.last_seen = time.time()
+
+        if len(packets) == 0:
+            return '8::'
+        if len(packets) == 1:
+            return packets[0]
+        return ''.join(u'\ufffd' + unicode(len(packet)) + u'\ufffd' + packet
+                for packet in packets)
+
+    def receive (self, payload):
+        self.last_seen = time.time()
+        for packet in decode_payload(payload):
+            parts = packet.split(':', 3)
+            while len(parts) < 4:
+                parts.append('')
+            (packet_type, packet_id, endpoint, data) = parts
+
+            if packet_type == '0':
+                # disconnect
+                self.close()
+            elif packet_type == '1':
+                # connect to a namespace, acknowledge it
+                if endpoint != '':
+                    self.send('1::' + endpoint)
+            elif packet_type == '2':
+                # heartbeat, last_seen is already updated
+                pass
+            elif packet_type == '5':
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+                if event.get('name') == 'query':
+                    for query in event.get('args', []):
+                        if isinstance(query, dict):
+                            self.broker.subscribe(self, endpoint, query)
+
+    def close (self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+            self.send('0::')
+
+
+def decode_payload (payload):
+    # split a socket.io 0.9 payload into packets. Multiple packets are framed
+    #   as \ufffd<length>\ufffd<packet>
+    if not payload.startswith(u'\ufffd'):
+        return [payload]
+    packets = []
+    index = 0
+    while index < len(payload) and payload[index] == u'\ufffd':
+        end = payload.index(u'\ufffd', index + 1)
+        length = int(payload[index+1:end])
+        packets.append(payload[end+1:end+1+length])
+        index = end + 1 + length
+    return packets
+
+
+class Server (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class Handler (BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    emulator = None
+
+    def log_message (self, format, *args):
+        pass
+
+    def reply (self, status, body, content_type='text/plain'):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body (self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+
+class PostHandler (Handler):
+
+    def do_POST (self):
+        profile_id = urlparse.urlsplit(self.path).path.strip('/')
+        try:
+            data = json.loads(self.read_body())
+        except ValueError:
+            self.reply(400, 'Bad JSON')
+            return
+        if not isinstance(data, dict) or profile_id == '':
+            self.reply(400, 'Expected a json object posted to /<profile_id>')
+            return
+
+        self.emulator.posts += 1
+        self.emulator.broker.publish(profile_id, data)
+        self.reply(200, '')
+
+
+class ExplorerHandler (Handler):
+
+    def do_GET (self):
+        path = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        if len(path) != 3 or path[0] != 'explore' or path[1] != 'profile':
+            self.reply(404, 'Not found')
+            return
+        self.reply(200, json.dumps(self.emulator.broker.explore(path[2])), 'application/json')
+
+
+class StreamHandler (Handler):
+
+    def do_GET (self):
+        path = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        if path[:2] != ['socket.io', '1']:
+            self.reply(404, 'Not found')
+            return
+
+        if len(path) == 2:
+            # handshake
+            session = self.emulator.new_session()
+            self.reply(200, session.sid + ':' + str(HEARTBEAT_TIMEOUT) + ':' +
+                    str(CLOSE_TIMEOUT) + ':xhr-polling')
+            return
+
+        session = self.session(path)
+        if session is not None:
+            self.reply(200, session.poll(), 'text/plain; charset=UTF-8')
+
+    def do_POST (self):
+        path = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        session = self.session(path)
+        if session is not None:
+            session.receive(self.read_body().decode('utf-8'))
+            self.reply(200, '1')
+
+    def session (self, path):
+        if len(path) != 4 or path[:3] != ['socket.io', '1', 'xhr-polling']:
+            self.reply(404, 'Not found')
+            return None
+        session = self.emulator.sessions.get(path[3])
+        if session is None or session.closed:
+            self.reply(404, 'Unknown session')
+            return None
+        return session
+
+
+class Emulator ():
+
+    def __init__ (self, host, port_offset):
+        self.broker = Broker()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.posts = 0
+        self.reconnects = 0
+
+        for (handler, port) in ((PostHandler, POST_PORT), (StreamHandler, STREAM_PORT),
+                (ExplorerHandler, EXPLORER_PORT)):
+            handler.emulator = self
+            server = Server((host, port + port_offset), handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def new_session (self):
+        session = Session(self.broker)
+        with self.lock:
+            self.sessions[session.sid] = session
+            self.reconnects += 1
+        return session
+
+    def expire_sessions (self):
+        now = time.time()
+        with self.lock:
+            for (sid, session) in self.sessions.items():
+                if session.closed or now - session.last_seen > CLOSE_TIMEOUT + POLL_DURATION:
+                    session.close()
+                    del self.sessions[sid]
+
+    def drop_sessions (self):
+        # force every client to reconnect
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+    def generate (self, rooms, interval, speedup, button_rate, command_rate):
+        # publish synthetic traffic in (scaled) real time
+        profiles = {
+                'presence': PRESENCE_PROFILE_ID,
+                'button': BUTTON_PROFILE_ID,
+                'command': LIGHT_COMMAND_PROFILE_ID,
+                }
+        start = time.time()
+        events = eventlog.synthetic_events(rooms, float('inf'), presence_interval=interval,
+                button_rate=button_rate, command_rate=command_rate,
+                start_time=start, seed=random.randint(0, 2**32))
+        for (event_time, data_type, pkt) in events:
+            delay = start + (event_time - start)/speedup - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.broker.publish(profiles[data_type], pkt)
+
+
+def zmq_publisher (port):
+    # a function publishing records on a ZeroMQ PUB socket
+    try:
+        import zmq
+    except ImportError:
+        print('Could not import the ZeroMQ library.')
+        print('sudo pip install pyzmq')
+        sys.exit(1)
+    sock = zmq.Context.instance().socket(zmq.PUB)
+    sock.bind('tcp://*:' + str(port))
+    lock = threading.Lock()
+
+    def publish (pkt):
+        # sockets aren't thread safe, and records are published from several
+        with lock:
+            sock.send(json.dumps(pkt, separators=(',', ':')))
+    return publish
+
+
+def main ():
+    if '--help' in sys.argv:
+        print(USAGE)
+        sys.exit(0)
+
+    host = get_option('host', 'localhost')
+    port_offset = int(get_option('port-offset', '0'))
+    rooms = int(get_option('rooms', '0'))
+    interval = float(get_option('interval', '60'))
+    speedup = float(get_option('speedup', '1'))
+    button_rate = float(get_option('button-rate', '0.5'))
+    command_rate = float(get_option('command-rate', '0.1'))
+    drop_every = float(get_option('drop-every', '0'))
+
+    emulator = Emulator(host, port_offset)
+    print("GATD emulator on " + host + " ports " + str(POST_PORT + port_offset) + ", " +
+            str(STREAM_PORT + port_offset) + ", " + str(EXPLORER_PORT + port_offset))
+
+    if get_option('publish-udp', None) is not None:
+        sender = localpath.Sender(*localpath.parse_address(get_option('publish-udp', None)))
+        emulator.broker.sinks.append(sender.send)
+        print("Publishing over UDP to " + get_option('publish-udp', None))
+    if get_option('publish-zmq', None) is not None:
+        emulator.broker.sinks.append(zmq_publisher(int(get_option('publish-zmq', None))))
+        print("Publishing over ZeroMQ on port " + get_option('publish-zmq', None))
+
+    if rooms > 0:
+        thread = threading.Thread(target=emulator.generate,
+                args=(rooms, interval, speedup, button_rate, command_rate))
+        thread.daemon = True
+        thread.start()
+        print("Generating traffic for " + str(rooms) + " rooms")
+
+    # report rates every ten seconds
+    last = (time.time(), 0, 0, 0)
+    last_drop = time.time()
+    while True:
+        time.sleep(10)
+        emulator.expire_sessions()
+
+        now = time.time()
+        if drop_every > 0 and now - last_drop >= drop_every:
+            emulator.drop_sessions()
+            last_drop = now
+            print("Dropped every stream client")
+
+        broker = emulator.broker
+        elapsed = now - last[0]
+        print("%d sessions, %.0f posts/s, %.0f published/s, %.0f delivered/s, %d connects" % (
+                len(emulator.sessions), (emulator.posts - last[1]) / elapsed,
+                (broker.published - last[2]) / elapsed, (broker.delivered - last[3]) / elapsed,
+                emulator.reconnects))
+        last = (now, emulator.posts, broker.published, broker.delivered)
+
+
+if __name__ == "__main__":
+    main()
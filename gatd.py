@@ -0,0 +1,411 @@
+# Helpers for talking to GATD
+#
+# All HTTP requests to GATD go through a shared pool of kept-alive
+#   connections with timeouts and retries. PostQueue sends records to a GATD
+#   profile from a background thread, so the code producing them never waits
+#   on the network, and JournaledPostQueue keeps them on disk until they're
+#   posted. Explorer listings are cached on disk, so picking a
+#   location at startup doesn't wait on GATD either.
+
+import os
+import json
+import errno
+import time
+import random
+import socket
+import httplib
+import urlparse
+import threading
+from collections import deque
+
+import logpipe
+import metrics
+
+# where GATD lives. Set GATD_HOST in the environment to point everything at
+#   another server, like gatd-emulator.py
+HOST = os.environ.get('GATD_HOST', 'gatd.eecs.umich.edu')
+POST_PORT = 8081
+STREAM_PORT = 8082
+EXPLORER_PORT = 8085
+
+POST_ADDR = 'http://' + HOST + ':' + str(POST_PORT) + '/'
+EXPLORER_ADDR = 'http://' + HOST + ':' + str(EXPLORER_PORT) + '/explore/profile/'
+
+# explorer listings younger than EXPLORER_TTL seconds are used from the cache
+#   without asking GATD. Older ones are still used if GATD can't be reached
+#   within EXPLORER_TIMEOUT
+EXPLORER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'apollito')
+EXPLORER_TTL = 24*60*60
+EXPLORER_TIMEOUT = 3.0
+
+
+class GATDError (Exception):
+    # GATD answered, but with an error status
+    pass
+
+# everything that a request to GATD can raise
+ERRORS = (GATDError, httplib.HTTPException, socket.error)
+
+
+class HTTPPool ():
+    # connections allowed to each host at once, including idle ones
+    MAX_CONNECTIONS = 8
+    TIMEOUT = 10.0
+    # failed requests are retried this many times, after a random delay of up
+    #   to RETRY_DELAY seconds which doubles with every attempt
+    RETRIES = 2
+    RETRY_DELAY = 0.5
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        # (host, port): list of idle connections
+        self.idle = {}
+        # (host, port): semaphore limiting connections in use
+        self.slots = {}
+
+    def request (self, method, url, body=None, headers=None, timeout=None, retries=None):
+        # returns (status, response body). Raises httplib.HTTPException or
+        #   socket.error if the request still fails after retrying
+        if timeout is None:
+            timeout = self.TIMEOUT
+        if retries is None:
+            retries = self.RETRIES
+        if headers is None:
+            headers = {}
+
+        url = urlparse.urlsplit(url)
+        key = (url.hostname, url.port or 80)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.MAX_CONNECTIONS)
+                self.idle[key] = []
+            slot = self.slots[key]
+
+        attempt = 0
+        while True:
+            slot.acquire()
+            try:
+                return self._request(key, method, path, body, headers, timeout)
+            except (httplib.HTTPException, socket.error):
+                if attempt >= retries:
+                    raise
+            finally:
+                slot.release()
+
+            # jittered exponential backoff so many clients don't retry at once
+            time.sleep(random.uniform(0, self.RETRY_DELAY * 2**attempt))
+            attempt += 1
+
+    def _request (self, key, method, path, body, headers, timeout):
+        # a kept-alive connection may have been closed by the server while
+        #   idle, so a reused connection is retried straight away on a fresh
+        #   one if it failed in a way that means the server never took the
+        #   request. Anything else, like a timeout, may come after the server
+        #   acted on it, and is left to the caller
+        while True:
+            conn = None
+            with self.lock:
+                if len(self.idle[key]) > 0:
+                    conn = self.idle[key].pop()
+            reused = conn is not None
+            if reused:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            else:
+                conn = httplib.HTTPConnection(key[0], key[1], timeout=timeout)
+
+            try:
+                conn.request(method, path, body, headers)
+            except socket.error, e:
+                conn.close()
+                if reused and e.errno in (errno.ECONNRESET, errno.EPIPE):
+                    continue
+                raise
+            try:
+                response = conn.getresponse()
+                data = response.read()
+            except httplib.BadStatusLine:
+                # closed without a word, which is how an idle connection dies
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle[key].append(conn)
+            return (response.status, data)
+
+POOL = HTTPPool()
+
+
+log = logpipe.get('gatd')
+
+POST_SECONDS = metrics.Histogram('gatd_post_seconds', 'Time taken by POSTs to GATD')
+POST_FAILURES = metrics.Counter('gatd_post_failures_total', 'POSTs to GATD that failed')
+
+
+def post (url, data, retries=None):
+    # post a json record to GATD
+    start = time.time()
+    try:
+        (status, body) = POOL.request('POST', url, json.dumps(data),
+                {'Content-Type': 'application/json'}, retries=retries)
+    except (httplib.HTTPException, socket.error):
+        POST_FAILURES.inc()
+        raise
+    finally:
+        POST_SECONDS.time(start)
+    if status >= 400:
+        POST_FAILURES.inc()
+        raise GATDError("HTTP " + str(status))
+
+def get_json (url, timeout=None, retries=None):
+    # fetch and decode a json document from GATD
+    (status, body) = POOL.request('GET', url, timeout=timeout, retries=retries)
+    if status != 200:
+        raise GATDError("HTTP " + str(status))
+    try:
+        return json.loads(body)
+    except ValueError, e:
+        raise GATDError("Bad JSON: " + str(e))
+
+def explore (profile_id, key):
+    # the values of key seen in a profile, from the explorer or its cache.
+    #   Raises one of ERRORS if GATD can't be reached and nothing is cached
+    path = os.path.join(EXPLORER_CACHE_DIR, HOST + '-' + profile_id + '.json')
+    cached = None
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+
+    if cached is None or age > EXPLORER_TTL:
+        try:
+            listing = get_json(EXPLORER_ADDR + profile_id, EXPLORER_TIMEOUT, retries=0)
+        except ERRORS, e:
+            if cached is None:
+                raise
+            log.warning("Using a cached explorer listing, GATD failed: %s", e)
+        else:
+            cached = listing
+            _write_cache(path, listing)
+
+    if not isinstance(cached.get(key), dict):
+        return []
+    return sorted(cached[key].keys())
+
+def _write_cache (path, listing):
+    try:
+        if not os.path.isdir(EXPLORER_CACHE_DIR):
+            os.makedirs(EXPLORER_CACHE_DIR)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(listing, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError), e:
+        log.warning("Failure to cache explorer listing: %s", e)
+
+
+class PostQueue (threading.Thread):
+    # records queued beyond this are dropped (oldest first) or spilled to disk
+    MAX_PENDING = 1000
+    # records sent back to back over one connection before checking the queue
+    BATCH_SIZE = 50
+    # seconds to wait before retrying after GATD couldn't be reached
+    RETRY_DELAY = 5.0
+
+    def __init__ (self, post_addr, spill_file=None):
+        super(PostQueue, self).__init__()
+        self.daemon = True
+
+        self.post_addr = post_addr
+
+        # if set, records that overflow the queue are appended to this file
+        #   as json lines and posted once the queue has drained
+        self.spill_file = spill_file
+
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.spilled = 0
+
+        # pick up anything left on disk by a previous run
+        if spill_file is not None and os.path.exists(spill_file):
+            with open(spill_file) as f:
+                self.spilled = sum(1 for line in f)
+
+        self.start()
+
+    def put (self, data):
+        with self.cond:
+            if len(self.pending) >= self.MAX_PENDING:
+                self._overflow(self.pending.popleft())
+            self.pending.append(data)
+            self.cond.notify()
+
+    def run (self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and self.spilled == 0:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    self._unspill()
+                batch = []
+                while len(self.pending) > 0 and len(batch) < self.BATCH_SIZE:
+                    batch.append(self.pending.popleft())
+
+            sent = self._post_batch(batch)
+            if sent < len(batch):
+                # GATD is unreachable. Put the rest back and wait a bit
+                with self.cond:
+                    for data in reversed(batch[sent:]):
+                        if len(self.pending) >= self.MAX_PENDING:
+                            self._overflow(data)
+                        else:
+                            self.pending.appendleft(data)
+                time.sleep(self.RETRY_DELAY)
+
+    def _post_batch (self, batch):
+        # post records over the pooled, kept-alive connection. Returns how
+        #   many were handled before GATD became unreachable
+        for (index, data) in enumerate(batch):
+            try:
+                post(self.post_addr, self._prepare(data), retries=0)
+            except GATDError, e:
+                # the server rejected it, retrying won't help
+                log.warning("Failure to POST to GATD: %s", e)
+            except (httplib.HTTPException, socket.error), e:
+                log.warning("Failure to POST to GATD: %s", e)
+                return index
+        return len(batch)
+
+    def _prepare (self, data):
+        # the record as it is posted, for subclasses to add to at send time
+        return data
+
+    def _overflow (self, data):
+        # called with the lock held
+        if self.spill_file is None:
+            self.dropped += 1
+            return
+        try:
+            with open(self.spill_file, 'a') as f:
+                f.write(json.dumps(data) + '\n')
+            self.spilled += 1
+        except IOError, e:
+            log.error("Failure to spill GATD record: %s", e)
+            self.dropped += 1
+
+    def _unspill (self):
+        # move spilled records back into the queue. Called with the lock held
+        #   once the queue is empty
+        try:
+            with open(self.spill_file) as f:
+                lines = f.readlines()
+            os.remove(self.spill_file)
+        except (IOError, OSError), e:
+            log.error("Failure to read spilled GATD records: %s", e)
+            lines = []
+        self.spilled = 0
+
+        for line in lines:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if len(self.pending) >= self.MAX_PENDING:
+                self._overflow(data)
+            else:
+                self.pending.append(data)
+
+
+class JournaledPostQueue (PostQueue):
+    # a PostQueue that also keeps every record in an append-only journal of
+    #   json lines until it has been posted, so records queued while GATD is
+    #   unreachable survive a crash or power cut. Meant for low rates, like
+    #   button presses: each record is one appended line, and the journal is
+    #   only rewritten after a batch is posted, or deleted once it's empty,
+    #   to go easy on flash. Records are posted at least once: a crash
+    #   between a post and the rewrite posts them again
+    MAX_PENDING = 1000
+
+    def __init__ (self, post_addr, journal):
+        self.journal = journal
+        super(JournaledPostQueue, self).__init__(post_addr)
+
+        records = []
+        try:
+            with open(journal) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # cut off by a crash
+                        continue
+        except IOError:
+            # nothing left over
+            pass
+        with self.cond:
+            self.pending.extend(records[-self.MAX_PENDING:])
+            self.dropped += max(0, len(records) - self.MAX_PENDING)
+            # drop any torn line and the records beyond the limit
+            self._rewrite(list(self.pending))
+            self.cond.notify()
+        if len(records) > 0:
+            log.info("Resending " + str(min(len(records), self.MAX_PENDING)) + " queued records")
+
+    def put (self, data):
+        with self.cond:
+            full = len(self.pending) >= self.MAX_PENDING
+            super(JournaledPostQueue, self).put(data)
+            if full:
+                # the oldest record was dropped
+                self._rewrite(list(self.pending))
+            else:
+                self._append(data)
+
+    def _post_batch (self, batch):
+        sent = super(JournaledPostQueue, self)._post_batch(batch)
+        if sent > 0:
+            with self.cond:
+                self._rewrite(batch[sent:] + list(self.pending))
+        return sent
+
+    def _append (self, data):
+        # called with the lock held
+        try:
+            if not os.path.isdir(os.path.dirname(self.journal) or '.'):
+                os.makedirs(os.path.dirname(self.journal))
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(data, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError), e:
+            log.error("Failure to journal GATD record: %s", e)
+
+    def _rewrite (self, records):
+        # replace the journal with records. Called with the lock held
+        try:
+            if len(records) == 0:
+                if os.path.exists(self.journal):
+                    os.remove(self.journal)
+                return
+            with open(self.journal + '.tmp', 'w') as f:
+                for data in records:
+                    f.write(json.dumps(data, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.journal + '.tmp', self.journal)
+        except (IOError, OSError), e:
+            log.error("Failure to rewrite GATD record journal: %s", e)
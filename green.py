@@ -0,0 +1,32 @@
+# Optional single threaded runtime
+#
+# Running with --green monkey patches the standard library with gevent so the
+#   background threads, the stream receivers, ACME++ reply listener, GATD
+#   post queue and the rest, all run as greenlets on one OS thread. A
+#   greenlet costs a few kilobytes rather than a thread stack, and switching
+#   between them happens on I/O rather than on GIL handoffs. Nothing else
+#   changes: the code is written for threads, and gevent makes them green.
+#
+# enable() must be called before anything imports socket or threading, so
+#   this module only imports sys at the top level.
+
+import sys
+
+ENABLED = False
+
+
+def requested ():
+    return '--green' in sys.argv
+
+def enable ():
+    global ENABLED
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        print('Could not import gevent, needed for --green.')
+        print('sudo pip install gevent')
+        sys.exit(1)
+
+    monkey.patch_all()
+    ENABLED = True
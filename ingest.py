@@ -0,0 +1,320 @@
+# Transports that bring GATD packets to the controllers
+#
+# However they travel, packets end up on a message queue as the same
+#   [data_type, pkt, recv_time] items, so the main loops don't care where
+#   they came from. start() opens a transport for a list of streams, each
+#   (profile_id, query, data_type), the way GATD is asked for them:
+#
+#   socketio  GATD's socket.io stream server, one connection per stream. The
+#             default. Needs socketIO-client
+#   udp       json datagrams of one packet each, received on a local port.
+#             override.py --controller sends its presses this way
+#   zmq       json messages from a ZeroMQ PUB socket, say a broker fanning
+#             GATD out to many controllers. Needs pyzmq
+#
+# The udp and zmq transports carry every profile over one socket. Packets
+#   are sorted into streams by their profile_id and checked against the
+#   stream queries here, as GATD would. gatd-emulator.py --publish-udp and
+#   --publish-zmq feed them for testing.
+
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import threading
+
+import gatd
+import green
+import localpath
+import logpipe
+import metrics
+
+try:
+    import socketIO_client as sioc
+    # the receivers log their own connection problems
+    logging.getLogger('socketIO_client').addHandler(logging.NullHandler())
+    _Namespace = sioc.BaseNamespace
+except ImportError:
+    sioc = None
+    _Namespace = object
+
+log = logpipe.get('ingest')
+
+TRANSPORTS = ('socketio', 'udp', 'zmq')
+ZMQ_PORT = 47654
+
+RECONNECTS = metrics.Counter('stream_reconnects_total', 'Reconnections to GATD streams')
+
+
+def start (transport, address, streams, message_queue):
+    # start receiving streams over transport, 'socketio', 'udp' or 'zmq'.
+    #   address is where from, None for the transport's default:
+    #     socketio: host[:port] of the GATD stream server
+    #     udp: [host:]port to listen on
+    #     zmq: the endpoint of the publisher, like tcp://host:port
+    if transport == 'socketio':
+        if sioc is None:
+            print('Could not import the socket.io client library.')
+            print('sudo pip install socketIO-client')
+            sys.exit(1)
+        (host, port) = (gatd.HOST, gatd.STREAM_PORT)
+        if address is not None:
+            (host, port) = localpath.parse_address(address, gatd.STREAM_PORT)
+        for (profile_id, query, data_type) in streams:
+            SocketIOReceiver(host, port, profile_id, query, data_type, message_queue)
+    elif transport == 'udp':
+        (host, port) = ('', localpath.PORT)
+        if address is not None:
+            if address.isdigit():
+                port = int(address)
+            else:
+                (host, port) = localpath.parse_address(address)
+        UDPReceiver(host, port, streams, message_queue)
+    elif transport == 'zmq':
+        ZMQReceiver(address or 'tcp://localhost:' + str(ZMQ_PORT), streams, message_queue)
+    else:
+        raise ValueError("unknown transport '" + transport + "'")
+
+def matches (query, pkt):
+    # whether a packet matches a stream query. profile_id picks the stream and
+    #   time picks where to resume from. Every other key must be equal, or be
+    #   one of the values listed as {'$in': [...]}
+    for (key, value) in query.items():
+        if key == 'profile_id' or key == 'time':
+            continue
+        if isinstance(value, dict) and '$in' in value:
+            if pkt.get(key) not in value['$in']:
+                return False
+        elif pkt.get(key) != value:
+            return False
+    return True
+
+
+class SocketIOReceiver (threading.Thread):
+    SOCKETIO_NAMESPACE = 'stream'
+
+    # reconnects wait a random time up to a delay that doubles from RETRY_MIN
+    #   to RETRY_MAX seconds, so streams don't all come back at once when GATD
+    #   blips. A connection that lasts HEALTHY_AFTER seconds resets the delay
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+    HEALTHY_AFTER = 60.0
+    # a connection is dropped if the server sends nothing at all, not even a
+    #   heartbeat or noop, for this many seconds
+    LIVENESS_TIMEOUT = 90
+    # streams of these types always have traffic, and are reconnected if no
+    #   data arrives for this many seconds
+    STALL_TIMEOUTS = {'presence': 5*60}
+    # seconds between checks. This also bounds how long a poll may be held
+    #   open, so it must be longer than the server's polling duration (20
+    #   seconds for socket.io 0.9) or packets are lost to abandoned polls
+    CHECK_INTERVAL = 30
+
+    def __init__ (self, host, port, profile_id, query, data_type, message_queue):
+        super(SocketIOReceiver, self).__init__()
+        self.daemon = True
+
+        # init data
+        self.host = host
+        self.port = port
+        self.profile_id = profile_id
+        self.data_type = data_type
+        self.message_queue = message_queue
+
+        # make query. Note that this overrides the profile id with the user's
+        #   choice if specified in query
+        profile_query = {'profile_id': profile_id}
+        self.query = dict(list(profile_query.items()) + list(query.items()))
+
+        # GATD time of the newest packet received, to resume from after a
+        #   reconnect
+        self.last_time = None
+        # local times anything, and any data, was last heard from the server
+        self.last_alive = time.time()
+        self.last_received = time.time()
+        self.connected = False
+
+        # start thread
+        self.start()
+
+    def run (self):
+        delay = self.RETRY_MIN
+        attempts = 0
+        while True:
+            if attempts > 0:
+                RECONNECTS.inc()
+                time.sleep(random.uniform(0, delay))
+                delay = min(2*delay, self.RETRY_MAX)
+            attempts += 1
+
+            connect_time = time.time()
+            socketIO = None
+            try:
+                # the client library's own retrying is turned off, it has no
+                #   backoff and doesn't reconnect namespaces
+                socketIO = sioc.SocketIO(self.host, self.port, wait_for_connection=False)
+                self.connected = True
+                socketIO.define(ConnectionReceiver).set_data(self)
+                stream_namespace = socketIO.define(StreamReceiver,
+                        '/{}'.format(self.SOCKETIO_NAMESPACE))
+                stream_namespace.set_data(self)
+                self.wait(socketIO)
+            except Exception, e:
+                # whatever went wrong, the stream has to be reconnected
+                log.warning("Lost the " + self.data_type + " stream: %s", e)
+            finally:
+                self.connected = False
+                if socketIO is not None:
+                    try:
+                        socketIO.disconnect()
+                    except Exception:
+                        pass
+
+            if time.time() - connect_time > self.HEALTHY_AFTER:
+                delay = self.RETRY_MIN
+
+    def wait (self, socketIO):
+        # returns once the connection drops or stalls
+        self.last_alive = self.last_received = time.time()
+        stall_timeout = self.STALL_TIMEOUTS.get(self.data_type)
+        while self.connected:
+            socketIO.wait(seconds=self.CHECK_INTERVAL)
+            now = time.time()
+            if now - self.last_alive > self.LIVENESS_TIMEOUT:
+                log.warning("No heartbeat on the " + self.data_type + " stream, reconnecting")
+                return
+            if stall_timeout is not None and now - self.last_received > stall_timeout:
+                log.warning("No data on the " + self.data_type + " stream for " +
+                        str(stall_timeout) + " seconds, reconnecting")
+                return
+        log.warning("The " + self.data_type + " stream disconnected")
+
+    def resume_query (self):
+        # the stream query, asking for anything missed since the newest packet
+        #   received if there was one
+        query = dict(self.query)
+        if self.last_time is not None:
+            query['time'] = self.last_time
+        return query
+
+    def received (self, pkt):
+        # data received from gatd. Push to msg_q along with when it arrived
+        now = time.time()
+        self.last_alive = self.last_received = now
+        if isinstance(pkt, dict) and isinstance(pkt.get('time'), (int, long, float)):
+            self.last_time = max(self.last_time, pkt['time'])
+        self.message_queue.put([self.data_type, pkt, now])
+
+
+class ConnectionReceiver (_Namespace):
+    # the root namespace of a connection, which heartbeats, noops and
+    #   disconnects arrive on
+
+    def set_data (self, receiver):
+        self.receiver = receiver
+
+    def on_heartbeat (self):
+        self.receiver.last_alive = time.time()
+
+    def on_noop (self):
+        self.receiver.last_alive = time.time()
+
+    def on_disconnect (self):
+        self.receiver.connected = False
+        # stop SocketIO.wait() now rather than at the end of its timeout
+        self._transport.disconnect()
+
+
+class StreamReceiver (ConnectionReceiver):
+
+    def on_reconnect (self):
+        self.emit('query', self.receiver.resume_query())
+
+    def on_connect (self):
+        self.receiver.last_alive = time.time()
+        self.emit('query', self.receiver.resume_query())
+
+    def on_data (self, *args):
+        self.receiver.received(args[0])
+
+
+class _Sorter (threading.Thread):
+    # base for transports that carry every profile over one socket
+
+    def __init__ (self, streams, message_queue):
+        super(_Sorter, self).__init__()
+        self.daemon = True
+        self.message_queue = message_queue
+        # profile_id: [(data_type, query)]
+        self.streams = {}
+        for (profile_id, query, data_type) in streams:
+            self.streams.setdefault(query.get('profile_id', profile_id), []).append(
+                    (data_type, query))
+
+    def received (self, data, recv_time, sender):
+        try:
+            pkt = json.loads(data)
+        except ValueError:
+            log.warning("Ignored a malformed packet from " + sender)
+            return
+        if not isinstance(pkt, dict):
+            return
+        # GATD stamps the packets it streams. Stamp any that weren't
+        pkt.setdefault('time', int(recv_time * 1000))
+        for (data_type, query) in self.streams.get(pkt.get('profile_id'), ()):
+            if matches(query, pkt):
+                self.message_queue.put([data_type, pkt, recv_time])
+
+
+class UDPReceiver (_Sorter):
+
+    def __init__ (self, host, port, streams, message_queue):
+        super(UDPReceiver, self).__init__(streams, message_queue)
+
+        # both IPv6 and IPv4 where possible
+        try:
+            self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            self.sock.bind((host or '::', port))
+        except socket.error:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind((host, port))
+        self.start()
+
+    def run (self):
+        while True:
+            try:
+                (data, sender) = self.sock.recvfrom(localpath.MAX_DATAGRAM)
+            except socket.error, e:
+                log.warning("Failure to receive: %s", e)
+                continue
+            self.received(data, time.time(), sender[0])
+
+
+class ZMQReceiver (_Sorter):
+
+    def __init__ (self, endpoint, streams, message_queue):
+        super(ZMQReceiver, self).__init__(streams, message_queue)
+        try:
+            if green.ENABLED:
+                import zmq.green as zmq
+            else:
+                import zmq
+        except ImportError:
+            print('Could not import the ZeroMQ library.')
+            print('sudo pip install pyzmq')
+            sys.exit(1)
+
+        # ZeroMQ connects in the background and reconnects by itself
+        self.endpoint = endpoint
+        self.sock = zmq.Context.instance().socket(zmq.SUB)
+        self.sock.setsockopt(zmq.SUBSCRIBE, b'')
+        self.sock.connect(endpoint)
+        self.start()
+
+    def run (self):
+        while True:
+            data = self.sock.recv()
+            self.received(data, time.time(), self.endpoint)
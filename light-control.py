@@ -1,330 +1,324 @@
 #!/usr/bin/env python
 
 import sys
-import time
-import Queue
-from threading import Thread
+import atexit
+import signal
 
-import json
-import urllib2
-import httplib
-import socket
+# the green runtime has to patch the standard library before it is imported
+import green
+if green.requested():
+    green.enable()
 
-try:
-    import socketIO_client as sioc
-except ImportError:
-    print('Could not import the socket.io client library.')
-    print('sudo pip install socketIO-client')
-    sys.exit(1)
+import time
+import Queue
+from threading import Thread, Event
+
+import acmepp
+import config
+import eventlog
+import gatd
+import ingest
+import logpipe
+import metrics
+import occupancy
+import roomcontrol
+import scheduler
+import statestore
 
 USAGE ="""
 Controls lights using an ACME++ based on occupancy data from GATD
 
 To perform continuous monitoring, please specify the location being monitored.
-Locations should be specified in the format:
+Multiple locations may be given on the command line to control several rooms
+from a single process. Locations should be specified in the format:
     University|Building|Room
+If none are given, every room in the --config file is controlled, and failing
+that a location is asked for.
+
+Options:
+    --config=<file>
+                json file describing rooms, devices, buttons, people and
+                timeouts, see config.py. Send SIGHUP to reload it
+    --green     run everything on a single thread using gevent
+    --no-prompt exit rather than ask for a location if none are given. This
+                is the default when not run from a terminal
+    --record=<file>
+                record every received event to file, for replay.py
+    --state=<file>
+                save the state of every room to file, and carry on from it
+                after a restart without resending anything
+    --refresh=<seconds>
+                how often to resend a device's state once it has settled,
+                default 300
+    --ack       use the acknowledged ACME++ protocol, for devices that
+                support it
+    --transport=<socketio|udp|zmq>
+                how to receive packets, see ingest.py. Default socketio,
+                from GATD
+    --transport-address=<address>
+                where to receive them from: host[:port] of the GATD stream
+                server, [host:]port to listen on for udp (default 47653),
+                or a ZeroMQ endpoint (default tcp://localhost:47654)
+    --local-port=<port>
+                also take button presses sent straight from override.py
+                --controller over UDP on port, usually 47653
+    --metrics-port=<port>
+                serve Prometheus metrics on http://localhost:<port>/metrics
+    --metrics-file=<file>
+                write a snapshot of the metrics to file every 10 seconds
+    --log-json  log one json object per line instead of text
 
 The following locations are monitored for occupancy:"""
-LOCATION = ""
-
-PRESENCE_PROFILE_ID = 'hsYQx8blbd'
-BUTTON_PROFILE_ID = '9YWtcF3MFW'
-LIGHT_COMMAND_PROFILE_ID = 'MUs0XwOiyp'
-LIGHT_PROFILE_ID = 'UbkhN72jvp'
-LIGHT_POST_ADDR = 'http://gatd.eecs.umich.edu:8081/' + LIGHT_PROFILE_ID
+LOCATIONS = []
+CONFIG = None
+
+# actions that can't be queued for GATD are written here rather than dropped.
+#   None to drop them
+LIGHT_SPILL_FILE = None
+LIGHT_POST_QUEUE = None
+
+MESSAGE_QUEUE_DEPTH = metrics.Gauge('message_queue_depth',
+        'Packets waiting in the message queue')
+MESSAGE_QUEUE_COALESCED = metrics.Counter('message_queue_coalesced_total',
+        'Presence packets replaced by a newer one for the same location before being handled')
+MESSAGE_QUEUE_DROPPED = metrics.Counter('message_queue_dropped_total',
+        'Packets dropped because the message queue was full')
+POST_QUEUE_DEPTH = metrics.Gauge('post_queue_depth',
+        'Action records waiting to be posted to GATD',
+        lambda: len(LIGHT_POST_QUEUE.pending))
+POST_QUEUE_DROPPED = metrics.Counter('post_queue_dropped_total',
+        'Action records dropped because the post queue was full',
+        lambda: LIGHT_POST_QUEUE.dropped)
+PACKETS = metrics.Counter('packets_total', 'Packets received from GATD streams')
+ACTUATION_LATENCY = metrics.Histogram('actuation_latency_seconds',
+        'Time from receiving a packet to sending the commands it caused')
+
+log = logpipe.get('control')
 
-ACMEpp_IPV6 = '2607:f018:800:10f:c298:e541:4310:1'
-ACMEpp_PORT = 47652
+def main():
+    global LOCATIONS, USAGE, CONFIG, LIGHT_POST_QUEUE
 
-PANEL_PEOPLE = [{'samkuo': 'Ye-Sheng Kuo'}]
-PANEL_IPV6 = '2607:f018:800:10f:c298:e541:4310:8'
-PANEL_PORT = 47652
+    # logs are written from a background thread so the loop never waits on
+    #   the terminal
+    logpipe.setup('--log-json' in sys.argv)
 
-def main():
-    global LOCATION, USAGE, BUTTON_PROFILE_ID, PRESENCE_PROFILE_ID
-
-    # get location from the user
-    LOCATION = get_location(USAGE, BUTTON_PROFILE_ID)
-    print("Running light control at " + LOCATION)
-
-    # start threads to receive data from GATD
-    query = {'location_str': LOCATION}
-    message_queue = Queue.Queue()
-    ReceiverThread(PRESENCE_PROFILE_ID, query, 'presence', message_queue)
-    ReceiverThread(BUTTON_PROFILE_ID, query, 'button', message_queue)
-    ReceiverThread(LIGHT_COMMAND_PROFILE_ID, query, 'command', message_queue)
-
-    # Create ACME++ object
-    acmepp = ACMEpp(ACMEpp_IPV6, ACMEpp_PORT, 'lights', LOCATION)
-    panel  = ACMEpp(PANEL_IPV6, PANEL_PORT, 'panel', LOCATION)
-
-    # variables for various states
-    temp_override_duration = 30
-
-    absence_start = 0
-    auto_light_state = 'On'
-    temp_override_start = 0
-    prev_temp_override_end = 0
-    manual_override  = False
-    manual_light_state = 'On'
-    state_change = True
-
-    panel_last_seen = 0
-    auto_panel_state = 'Off'
-    panel_temp_override_start = 0
-    panel_manual_override = False
-    manual_panel_state = 'Off'
-    panel_change = True
+    # rooms, devices and profiles
+    try:
+        CONFIG = config.load(get_option('config'))
+    except config.ConfigError, e:
+        print("Invalid configuration: " + str(e))
+        sys.exit(1)
+    profiles = CONFIG.profiles
+
+    transport = get_option('transport', 'socketio')
+    if transport not in ingest.TRANSPORTS:
+        print("Unknown transport: " + transport)
+        sys.exit(1)
+
+    # get locations from the user
+    LOCATIONS = get_locations(USAGE, profiles.button, sorted(CONFIG.rooms))
+    log.info("Running light control at " + ', '.join(LOCATIONS))
+
+    warn_shared_devices(CONFIG, LOCATIONS)
+
+    acmepp.ACMEpp.refresh_interval = float(get_option('refresh', acmepp.ACMEpp.refresh_interval))
+
+    # actions are posted to GATD from a background thread
+    LIGHT_POST_QUEUE = gatd.PostQueue(gatd.POST_ADDR + profiles.light, LIGHT_SPILL_FILE)
+
+    # expose metrics
+    if get_option('metrics-port') is not None:
+        metrics.MetricsServer(int(get_option('metrics-port')))
+    if get_option('metrics-file') is not None:
+        metrics.SnapshotWriter(get_option('metrics-file'))
+
+    # every ACME++ sends through one shared socket, in a batch per loop
+    actuators = acmepp.ActuatorManager(post_to_gatd, '--ack' in sys.argv)
+
+    # room state saved by an earlier run
+    store = None
+    if get_option('state') is not None:
+        store = statestore.StateStore(get_option('state'))
+
+    # create a state machine for each room
+    router = roomcontrol.Router()
+    timers = scheduler.Scheduler()
+    current_time = int(round(time.time()))
+    for location in LOCATIONS:
+        room = Room(location, current_time, actuators, CONFIG.room(location), store)
+        router.add(location, room, room.controller.buttons)
+        timers.schedule(room, room.update(time.time()))
+    actuators.flush()
+
+    # start receiving data from GATD. However many rooms there are, each
+    #   profile is asked for only the locations and devices being controlled.
+    #   Presence snapshots waiting for the same room are collapsed into the
+    #   latest, and buttons and commands jump the line
+    message_queue = scheduler.IngestQueue()
+    MESSAGE_QUEUE_DEPTH.function = message_queue.qsize
+    MESSAGE_QUEUE_COALESCED.function = lambda: message_queue.coalesced
+    MESSAGE_QUEUE_DROPPED.function = lambda: message_queue.dropped
+    receiver_queue = message_queue
+    if get_option('record') is not None:
+        receiver_queue = eventlog.Recorder(get_option('record'), message_queue)
+        atexit.register(receiver_queue.close)
+
+    # exit cleanly, closing the recording, on SIGTERM as well as SIGINT. The
+    #   signal arrives on whichever thread, but its handler runs on the main
+    #   thread, which may be asleep in select(). Writing to the queue's wake
+    #   up pipe gets it up to run the handler
+    signal.set_wakeup_fd(message_queue.wake_w)
+    signal.signal(signal.SIGTERM, stop)
+    streams = [
+            (profiles.presence, router.query('presence'), 'presence'),
+            (profiles.button, router.query('button'), 'button'),
+            (profiles.command, router.query('command'), 'command'),
+            ]
+    ingest.start(transport, get_option('transport-address'), streams, receiver_queue)
+    if get_option('local-port') is not None:
+        ingest.start('udp', get_option('local-port'), streams[1:2], receiver_queue)
+    actuators.start_receiving(message_queue)
+
+    # reload the configuration on SIGHUP
+    if get_option('config') is not None:
+        ReloadThread(get_option('config'), message_queue)
 
     # process packets
     while True:
 
-        # process light states
-        # Note: these command the lights at a minimum of every 10 seconds
-        #   (timeout period) and a maximum of however fast packets arrive.
-        #   This can get kind of fast with macScanner, so it is rate limited
-        #   in the acmepp class to one real transmission per 10 seconds. This
-        #   is okay because we will send another packet within a maximum of 10
-        #   seconds, and the lights don't change that quickly
-        if manual_override == True or temp_override_start != 0:
-            # manual control of lights
-            if manual_light_state == 'On':
-                acmepp.setOn(state_change)
-                if state_change == True:
-                    print(cur_datetime() + ": Manual lights on")
-            else:
-                acmepp.setOff(state_change)
-                if state_change == True:
-                    print(cur_datetime() + ": Manual lights off")
-        else:
-            # automatic control of lights
-            if auto_light_state == 'On':
-                acmepp.setOn(state_change)
-                if state_change == True:
-                    print(cur_datetime() + ": Automatic lights on")
-            else:
-                acmepp.setOff(state_change)
-                if state_change == True:
-                    print(cur_datetime() + ": Automatic lights off")
-        if panel_manual_override == True or panel_temp_override_start != 0:
-            # manual control of panel
-            if manual_panel_state == 'On':
-                panel.setOn(panel_change)
-                if panel_change == True:
-                    print(cur_datetime() + ": Manual panel on")
-            else:
-                panel.setOff(panel_change)
-                if panel_change == True:
-                    print(cur_datetime() + ": Manual panel off")
-        else:
-            # automatic control of panel
-            if auto_panel_state == 'On':
-                panel.setOn(panel_change)
-                if panel_change == True:
-                    print(cur_datetime() + ": Automatic panel on")
-            else:
-                panel.setOff(panel_change)
-                if panel_change == True:
-                    print(cur_datetime() + ": Automatic panel off")
-        panel_change = False
-        state_change = False
+        # sleep until the next packet arrives or the next room timeout or
+        #   retransmission is due, whichever comes first
+        timeout = None
+        deadline = timers.next_deadline()
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
 
         pkt = None
         try:
             # Pull data from message queue
-            [data_type, pkt] = message_queue.get(timeout=1)
+            [data_type, pkt, recv_time] = message_queue.get(timeout=timeout)
         except Queue.Empty:
             # No data has been seen, handle timeouts
             pass
 
-        current_time = int(round(time.time()))
-
-        # turn off override mode if it's been a full duration
-        if temp_override_start != 0 and (current_time - temp_override_start) > temp_override_duration*60:
-            temp_override_start = 0
-            prev_temp_override_end = current_time
-            state_change = True
-            print(cur_datetime() + ": Override lights timed out")
-        if (panel_temp_override_start != 0 and
-                (current_time - panel_temp_override_start) > temp_override_duration*60):
-            panel_temp_override_start = 0
-            # no need to do the backoff stuff
-            panel_change = True
-            print(cur_datetime() + ": Override panel timed out")
-
-        # turn off lights if it's been ten minutes with no people
-        if absence_start != 0 and (current_time - absence_start) > 10*60:
-            absence_start = 0
-            auto_light_state = 'Off'
-            state_change = True
-            print(cur_datetime() + ": No one seen for ten minutes")
-
-        # turn off the panel too
-        if auto_panel_state == 'On':
-            if (current_time - panel_last_seen) > 30*60:
-                auto_panel_state = 'Off'
-                panel_change = True
+        now = time.time()
+        current_time = int(round(now))
+
+        for room in timers.pop_due(now):
+            room.apply(room.controller.on_tick(current_time), 'timeout')
+            timers.schedule(room, room.update(now))
+        actuators.flush()
+
+        # a reloaded configuration, swapped in between packets
+        if pkt != None and data_type == 'reload':
+            reconfigure(pkt, router, timers, now)
+            actuators.flush()
+            continue
+
+        # replies from ACME++s in ack mode
+        if pkt != None and data_type == 'ack':
+            (sender, data) = pkt
+            for device in actuators.receive(sender, data, now):
+                room = router.rooms[device.location]
+                timers.schedule(room, room.update(now))
+            actuators.flush()
+            continue
 
         # skip packet if it doesn't contain enough data to use
         if (pkt == None or 'location_str' not in pkt or 'time' not in pkt):
             continue
 
-        # skip packet if not for this location
-        if pkt['location_str'] != LOCATION:
+        # skip packet if not for a monitored location or device
+        room = router.route(data_type, pkt)
+        if room is None:
             continue
 
-        # Button data
-        # This data comes in single packets idntifying that a button press has
-        #   occurred. On the appropriate button press, light control will be
-        #   overriden for a half-hour and the lights will be turned on
-        if data_type == 'button':
-            if 'device_id' in pkt and pkt['device_id'] == 'b827eb0a2b8f':
-                if 'button_id' in pkt and pkt['button_id'] == 25:
-                    # this is the right button, do action based on state
-                    if manual_override == False:
-                        # determine how long the duration should be
-                        if (prev_temp_override_end != 0 and
-                                (current_time - prev_temp_override_end) < 10*60):
-                            # if the button gets pressed again within 10 minutes of the timeout,
-                            #   double the duration of the temporary override
-                            temp_override_duration *= 2
-                        else:
-                            # otherwise return to a normal duration
-                            temp_override_duration = 30
-
-                        # enable lights for some time
-                        temp_override_start = current_time
-                        prev_temp_override_end = 0
-                        manual_light_state = 'On'
-                        state_change = True
-                        print(cur_datetime() + ": Button Override! Lights on for 30 minutes")
-                    else:
-                        # resume automatic control
-                        temp_override_start = 0
-                        manual_override = False
-                        manual_light_state = 'On'
-                        state_change = True
-                        print(cur_datetime() + ": Button Override! Control resumed")
-
-        # Presence data
-        # This data comes from Whereabouts in single packets containing a list
-        #   of the people current present
-        if data_type == 'presence' and 'person_list' in pkt:
-            if len(pkt['person_list']) == 0:
-                # no one is here! start a count and wait for 10 minutes
-                #   before actually turning off the lights
-                if absence_start == 0 and auto_light_state == 'On':
-                    absence_start = current_time
-            else:
-                # someone is here! make sure the lights are on and stop
-                #   any running counter
-                absence_start = 0
-                if auto_light_state == 'Off':
-                    auto_light_state = 'On'
-                    state_change = True
-                    print(cur_datetime() + ": Someone is seen!")
-
-                # turn on or off light panel based on people who like it
-                if auto_panel_state == 'On':
-                    if any(person in pkt['person_list'] for person in PANEL_PEOPLE):
-                        panel_last_seen = current_time
-                else:
-                    if any(person in pkt['person_list'] for person in PANEL_PEOPLE):
-                        panel_last_seen = current_time
-                        auto_panel_state = 'On'
-                        panel_change = True
-
-        # Command data
-        # This data comes from commands sent by the 4908 script. Commands
-        #   include 'stay_on', 'stay_off', 'resume', 'on', and 'off'
-        if data_type == 'command' and 'light_command' in pkt:
-            if pkt['light_command'] == 'on':
-                # temporary override of lights
-                temp_override_start = current_time
-                manual_override = False
-                manual_light_state = 'On'
-                state_change = True
-                print(cur_datetime() + ": Command override! Temporary on")
-            if pkt['light_command'] == 'off':
-                # temporary override of lights
-                temp_override_start = current_time
-                manual_override = False
-                manual_light_state = 'Off'
-                state_change = True
-                print(cur_datetime() + ": Command override! Temporary off")
-            if pkt['light_command'] == 'stay_on':
-                # permanent manual control
-                temp_override_start = 0
-                manual_override = True
-                manual_light_state = 'On'
-                state_change = True
-                print(cur_datetime() + ": Command override! Stay on")
-            if pkt['light_command'] == 'stay_off':
-                # permanent manual control
-                temp_override_start = 0
-                manual_override = True
-                manual_light_state = 'Off'
-                state_change = True
-                print(cur_datetime() + ": Command override! Stay off")
-
-            if pkt['light_command'] == 'panel_on':
-                # temporary override of panel
-                panel_temp_override_start = current_time
-                panel_manual_override = False
-                manual_panel_state = 'On'
-                panel_change = True
-                print(cur_datetime() + ": Command override! Temporary panel on")
-            if pkt['light_command'] == 'panel_off':
-                # temporary override of panel
-                panel_temp_override_start = current_time
-                panel_manual_override = False
-                manual_panel_state = 'Off'
-                panel_change = True
-                print(cur_datetime() + ": Command override! Temporary panel off")
-            if pkt['light_command'] == 'panel_stay_on':
-                # permanent manual control
-                panel_temp_override_start = 0
-                panel_manual_override = True
-                manual_panel_state = 'On'
-                panel_change = True
-                print(cur_datetime() + ": Command override! Panel stay on")
-            if pkt['light_command'] == 'panel_stay_off':
-                # permanent manual control
-                panel_temp_override_start = 0
-                panel_manual_override = True
-                manual_panel_state = 'Off'
-                panel_change = True
-                print(cur_datetime() + ": Command override! Panel stay off")
-
-            if pkt['light_command'] == 'resume':
-                # turn off manual_control
-                temp_override_start = 0
-                manual_override = False
-                state_change = True
-                panel_temp_override_start = 0
-                panel_manual_override = False
-                panel_change = True
-                print(cur_datetime() + ": Command override! Resume control")
-
-
-def cur_datetime():
-    return time.strftime("%m/%d/%Y %H:%M")
+        PACKETS.inc()
+        room.apply(room.controller.on_event(data_type, pkt, current_time), data_type)
+        timers.schedule(room, room.update(now))
+        if actuators.flush() > 0:
+            ACTUATION_LATENCY.time(recv_time)
+
+
+def reconfigure(new_config, router, timers, now):
+    global CONFIG
+
+    # streams are left running, so changes to what they subscribe to wait for
+    #   a restart
+    for location in set(new_config.rooms) - set(router.rooms):
+        log.warning("Not controlling " + location + " until restarted")
+    # a room dropped from the file keeps its settings rather than falling
+    #   back on the defaults, and their devices
+    rooms = dict(new_config.rooms)
+    for location in set(CONFIG.rooms) - set(new_config.rooms):
+        if location in router.rooms:
+            log.warning("Still controlling " + location + " as before until restarted")
+            rooms[location] = CONFIG.rooms[location]
+    new_config = new_config._replace(rooms=rooms)
+    warn_shared_devices(new_config, router.rooms)
+    if new_config.profiles != CONFIG.profiles:
+        log.warning("Profile changes take effect on restart")
+    button_query = router.query('button')
+
+    for (location, room) in router.rooms.items():
+        room.reconfigure(new_config.room(location))
+        router.add(location, room, room.controller.buttons)
+        timers.schedule(room, room.update(now))
+    if router.query('button') != button_query:
+        log.warning("Presses of new buttons are received once restarted")
+
+    CONFIG = new_config
+    log.info("Reloaded configuration")
+
+def stop(signum, frame):
+    sys.exit(0)
+
+def warn_shared_devices(configuration, locations):
+    # rooms left on the default devices, or keeping old ones after a reload,
+    #   can end up sharing them
+    rooms = dict((location, configuration.room(location)) for location in locations)
+    for ((addr, port), users) in sorted(config.shared_devices(rooms).items()):
+        log.warning("[" + addr + "]:" + str(port) + " is shared by " +
+                ', '.join(location + " " + name for (location, name) in sorted(users)) +
+                ", give each room its own devices with --config")
 
 def post_to_gatd(data):
-    global LIGHT_POST_ADDR
+    global LIGHT_POST_QUEUE
 
-    try:
-        req = urllib2.Request(LIGHT_POST_ADDR)
-        req.add_header('Content-Type', 'application/json')
-        response = urllib2.urlopen(req, json.dumps(data))
-    except (httplib.BadStatusLine, urllib2.URLError), e:
-        # ignore error and carry on
-        print("Failure to POST to GATD: " + str(e))
+    # queue the record, it gets posted by a background thread so actuation
+    #   never waits on GATD
+    LIGHT_POST_QUEUE.put(data)
 
-def get_location(usage, profile_id):
+def get_option(name, default=None):
+    # returns the value of a --name=value command line option
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def get_locations(usage, profile_id, configured=[]):
+
+    # every command line argument other than options is a location to
+    #   control
+    locations = [arg for arg in sys.argv[1:] if arg != '' and not arg.startswith('--')]
+    if len(locations) > 0:
+        return locations
+
+    # then every room in the configuration file
+    if len(configured) > 0:
+        return configured
+
+    # otherwise ask the user for a single location, if there is one to ask
+    if '--no-prompt' in sys.argv or not sys.stdin.isatty():
+        print("No location given on the command line or in --config")
+        sys.exit(1)
+    return [get_location(usage, profile_id, locations)]
+
+def get_location(usage, profile_id, args):
 
     # get location selection from user
-    if len(sys.argv) != 2 or sys.argv[1] == '':
+    if len(args) != 1 or args[0] == '':
         print(usage)
 
         # get a list of previously monitored locations
@@ -350,143 +344,157 @@ def get_location(usage, profile_id):
         else:
             return user_input
     else:
-        return sys.argv[1]
+        return args[0]
 
 def query_gatd_explorer(profile_id, key):
-    explorer_addr = 'http://gatd.eecs.umich.edu:8085/explore/profile/' + profile_id
 
-    # query GATD explorer to find scan locations
+    # query GATD explorer, or the cached listing, to find scan locations
     try:
-        req = urllib2.Request(explorer_addr)
-        response = urllib2.urlopen(req)
-    except (httplib.BadStatusLine, urllib2.URLError), e:
-        print("Connection to GATD failed: " + str(e))
-        return ['None']
-
-    json_data = json.loads(response.read())
-    if key in json_data:
-        return json_data[key].keys()
-    else:
-        return ['None']
+        return gatd.explore(profile_id, key)
+    except gatd.ERRORS, e:
+        log.warning("Connection to GATD failed: %s", e)
+        return []
 
 
-class ACMEpp ():
-    transmission_limit = 10.0
+class Room ():
 
-    def __init__ (self, ipv6_addr, port, name, location):
-        self.s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-        self.addr = ipv6_addr
-        self.port = port
-        self.name = name
+    def __init__ (self, location, current_time, actuators, room_config, store=None):
         self.location = location
-        self.last_post_time = 0
-
-        # actually, it's unknown, but good enough
-        self.on = False
-
-    def setOn (self, state_change):
-        if state_change:
-            self.transmission_limit = 0.25
-
-        # only actually send an on packet if rate-limiting say its okay
-        if (self._should_transmit()):
-            self._post_action('on')
-            self.s.sendto('\x01'.encode(), (self.addr, self.port))
-            self.on = True
-
-    def setOff (self, state_change):
-        if state_change:
-            self.transmission_limit = 0.25
-
-        # only actually send an on packet if rate-limiting say its okay
-        if (self._should_transmit()):
-            self._post_action('off')
-            self.s.sendto('\x02'.encode(), (self.addr, self.port))
-            self.on = False
-
-    def _should_transmit (self):
-        # rate-limiting packet transmissions
-        if (time.time() - self.last_post_time) > self.transmission_limit:
-            self.last_post_time = time.time()
-            return True
-
-        # exponential backoff
-        self.transmission_limit *= 2
-        if self.transmission_limit > 10.0:
-            self.transmission_limit = 10.0
-
-        return False
-
-    def _post_action (self, action):
-        data = {
-                'action': action,
-                'acmepp_addr': self.addr,
-                'acmepp_port': self.port,
-                'name': self.name,
-                'location_str': self.location
+        self.actuators = actuators
+        self.store = store
+        # the state last queued to be saved
+        self.saved = None
+        self.controller = roomcontrol.RoomController(location, room_config.buttons,
+                room_config.likes, room_config.absence_timeout, room_config.panel_timeout)
+        if room_config.adaptive_timeout:
+            self.controller.model = occupancy.OccupancyModel()
+        self.log = logpipe.room(location)
+
+        # Create ACME++ objects
+        self.devices = {}
+        for (name, (addr, port)) in room_config.devices.items():
+            self.devices[name] = actuators.device(addr, port, name, location)
+
+        # pick up where the last run left off, or send the initial state
+        if store is not None and store.get(location) is not None:
+            self.restore(store.get(location), time.time())
+        self.apply(self.controller.on_tick(current_time), 'start')
+
+    def state (self):
+        return {
+                'controller': self.controller.state(),
+                # what each device is known to be in, not what it was last
+                #   told, so a command cut short by a restart is sent again
+                'confirmed': dict((name, device.confirmed)
+                        for (name, device) in self.devices.items()),
                 }
-        post_to_gatd(data)
-
-
-class ReceiverThread (Thread):
-    SOCKETIO_HOST = 'gatd.eecs.umich.edu'
-    SOCKETIO_PORT = 8082
-    SOCKETIO_NAMESPACE = 'stream'
 
-
-    def __init__(self, profile_id, query, data_type, message_queue):
-        super(ReceiverThread, self).__init__()
+    def restore (self, state, now):
+        self.controller.restore(state.get('controller', {}))
+        self.log.info("Restored saved state", extra={'event': 'start'})
+
+        # devices confirmed in the right state are left alone. Any still
+        #   being sent their last command before the restart get it again,
+        #   with fast retries
+        confirmed = state.get('confirmed', {})
+        wanted = {
+                'lights': self.controller.light_state()[0] == 'On',
+                'panel': self.controller.panel_state()[0] == 'On',
+                }
+        for (name, device) in self.devices.items():
+            if confirmed.get(name) == wanted[name]:
+                device.restore(wanted[name], now)
+            else:
+                self.controller.resend(name)
+
+    def reconfigure (self, room_config):
+        # take on new settings, keeping the room's state
+        self.controller.buttons = room_config.buttons
+        self.controller.likes = room_config.likes
+        self.controller.absence_timeout = room_config.absence_timeout
+        self.controller.panel_timeout = room_config.panel_timeout
+        if not room_config.adaptive_timeout:
+            self.controller.model = None
+        elif self.controller.model is None:
+            self.controller.model = occupancy.OccupancyModel()
+
+        for (name, (addr, port)) in room_config.devices.items():
+            device = self.devices[name]
+            if (device.addr, device.port) == (addr, port):
+                continue
+            # a replaced device is brought to the state of the old one
+            self.log.info("Now using " + name + " at [" + addr + "]:" + str(port),
+                    extra={'device': name, 'event': 'reload'})
+            self.actuators.remove(device)
+            self.devices[name] = self.actuators.device(addr, port, name, self.location)
+            if device.on is True:
+                self.devices[name].setOn()
+            elif device.on is False:
+                self.devices[name].setOff()
+
+    def apply (self, commands, event):
+        # carry out commands made in response to event
+        for command in commands:
+            context = {'device': command.device, 'event': event}
+            if command.reason:
+                self.log.info(command.reason, extra=context)
+            mode = "Manual " if command.manual else "Automatic "
+            self.log.info(mode + command.device + " " + command.state.lower(), extra=context)
+            if command.state == 'On':
+                self.devices[command.device].setOn()
+            else:
+                self.devices[command.device].setOff()
+
+    def update (self, now):
+        # send any retransmissions that are due, and save the room's state.
+        #   Returns the next time this room needs attention, either for a
+        #   timeout or a retransmission
+        deadline = self.controller.next_deadline()
+        for device in self.devices.values():
+            transmit_time = device.service(now)
+            if deadline is None or (transmit_time is not None and transmit_time < deadline):
+                deadline = transmit_time
+
+        # after servicing, which is when devices become confirmed
+        if self.store is not None:
+            # most packets, say presence with nobody new, change nothing
+            state = self.state()
+            if state != self.saved:
+                self.store.put(self.location, state)
+                self.saved = state
+        return deadline
+
+
+class ReloadThread (Thread):
+    # reloads the configuration file on SIGHUP. The file is read and checked
+    #   on this thread, and only a valid configuration is passed to the main
+    #   loop, as a ['reload', config, recv_time] item
+
+    def __init__(self, path, message_queue):
+        super(ReloadThread, self).__init__()
         self.daemon = True
-
-        # init data
-        self.profile_id = profile_id
-        self.data_type = data_type
+        self.path = path
         self.message_queue = message_queue
-        self.stream_namespace = None
+        self.requested = Event()
 
-        # make query. Note that this overrides the profile id with the user's
-        #   choice if specified in query
-        profile_query = {'profile_id': profile_id}
-        self.query = dict(list(profile_query.items()) + list(query.items()))
-
-        # start thread
+        # main() has the signal wake the main loop to run the handler
+        signal.signal(signal.SIGHUP, self.on_signal)
         self.start()
 
+    def on_signal(self, signum, frame):
+        self.requested.set()
+
     def run(self):
         while True:
+            self.requested.wait()
+            self.requested.clear()
             try:
-                socketIO = sioc.SocketIO(self.SOCKETIO_HOST, self.SOCKETIO_PORT)
-                self.stream_namespace = socketIO.define(StreamReceiver,
-                        '/{}'.format(self.SOCKETIO_NAMESPACE))
-                self.stream_namespace.set_data(self.query, self.data_type, self.message_queue,
-                        self.stream_namespace)
-                socketIO.wait()
-            except sioc.exceptions.ConnectionError:
-                # ignore error and continue
-                socketIO.disconnect()
-
-
-class StreamReceiver (sioc.BaseNamespace):
-
-    def set_data (self, query, data_type, message_queue, stream_namespace):
-        self.query = query
-        self.data_type = data_type
-        self.message_queue = message_queue
-        self.stream_namespace = stream_namespace
-
-    def on_reconnect (self):
-        if 'time' in query:
-            del query['time']
-        self.stream_namespace.emit('query', self.query)
-
-    def on_connect (self):
-        self.stream_namespace.emit('query', self.query)
-
-    def on_data (self, *args):
-        # data received from gatd. Push to msg_q
-        self.message_queue.put([self.data_type, args[0]])
+                new_config = config.load(self.path)
+            except config.ConfigError, e:
+                log.error("Not reloading configuration: %s", e)
+                continue
+            self.message_queue.put(['reload', new_config, time.time()])
 
 
 if __name__ == "__main__":
     main()
-
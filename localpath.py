@@ -0,0 +1,47 @@
+# Button presses sent straight to the controller over the local network
+#
+# A press posted to GATD only reaches light-control.py after a round trip
+#   through GATD and back down the button stream, which takes seconds and
+#   stops altogether while GATD is down. override.py can also send each press
+#   as a json UDP datagram directly to the controller, which receives it with
+#   the udp transport of ingest.py and acts on it in milliseconds. Both
+#   copies carry the same pressed_at time, so the room acts on whichever
+#   arrives first and ignores the other (see RoomController._on_button).
+
+import json
+import socket
+
+import logpipe
+
+log = logpipe.get('local')
+
+PORT = 47653
+MAX_DATAGRAM = 4096
+
+
+def parse_address (value, port=PORT):
+    # 'host', 'host:port', 'ipv6' or '[ipv6]:port' to (host, port)
+    if value.startswith('['):
+        (host, _, rest) = value[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+        return (host, port)
+    if value.count(':') == 1:
+        (host, port) = value.split(':')
+        return (host, int(port))
+    return (value, port)
+
+
+class Sender ():
+
+    def __init__ (self, host, port=PORT):
+        (family, _, _, _, self.addr) = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+    def send (self, pkt):
+        # best effort, the GATD copy still gets there if this one is lost
+        try:
+            self.sock.sendto(json.dumps(pkt, separators=(',', ':')), self.addr)
+        except socket.error, e:
+            log.warning("Failure to send to the controller: %s", e)
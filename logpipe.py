@@ -0,0 +1,224 @@
+# Structured logging that never blocks the control loop
+#
+# Logging a record only appends it to a bounded queue. A background thread
+#   formats the queued records and writes them out in batches, so a slow
+#   terminal or journald pipe holds up the writer rather than actuation. If
+#   the writer falls more than MAX_PENDING records behind, new records are
+#   dropped and counted instead of waiting.
+#
+# Records carry context fields - location, device and event - given with
+#   extra={...} or bound to a room with room(). They are written either as
+#   text:
+#       10/18/2026 14:02:11.318 INFO location=Univ|Bldg|Room device=lights event=button: Manual lights on
+#   or, with json_lines, as one json object per line.
+#
+# A warning or error repeated with the same context within REPEAT_WINDOW
+#   seconds is suppressed, and the number suppressed is noted on the next one
+#   written. Repeats are told apart by the message before formatting, with
+#   any exception given as an argument reduced to its type, so
+#   log.warning("Failure to POST to GATD: %s", e) is one message however the
+#   text of e varies from attempt to attempt. Informational records, like
+#   state changes, are always written.
+
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+ROOT = 'apollito'
+
+MAX_PENDING = 10000
+REPEAT_WINDOW = 60.0
+# seconds to wait for queued records to be written at exit
+FLUSH_TIMEOUT = 1.0
+
+# fields that are written with every record that has them
+CONTEXT = ('location', 'device', 'event')
+
+DROPPED = metrics.Counter('log_records_dropped_total',
+        'Log records dropped because the writer fell behind')
+SUPPRESSED = metrics.Counter('log_records_suppressed_total',
+        'Log records suppressed as repeats')
+
+
+def get (name):
+    # the logger for part of the controller
+    return logging.getLogger(ROOT + '.' + name)
+
+def room (location):
+    # a logger that adds location to everything logged through it
+    return ContextLogger(get('room'), {'location': location})
+
+def setup (json_lines=False, stream=sys.stdout, level=logging.INFO):
+    # send everything logged under ROOT to stream through a background writer
+    handler = BackgroundHandler(stream)
+    handler.setFormatter(Formatter(json_lines))
+    handler.addFilter(RepeatFilter())
+    logger = logging.getLogger(ROOT)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return handler
+
+
+class ContextLogger (logging.LoggerAdapter):
+    # merges the fields bound to the adapter with any passed per call, which
+    #   the standard adapter would overwrite
+
+    def process (self, msg, kwargs):
+        extra = dict(self.extra)
+        extra.update(kwargs.get('extra', {}))
+        kwargs['extra'] = extra
+        return (msg, kwargs)
+
+
+class RepeatFilter (logging.Filter):
+
+    def __init__ (self, window=REPEAT_WINDOW, level=logging.WARNING):
+        # only records at level or above are suppressed
+        logging.Filter.__init__(self)
+        self.window = window
+        self.level = level
+        self.lock = threading.Lock()
+        # key: [time first written, number suppressed since]
+        self.seen = {}
+
+    def filter (self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, record.msg, _stable(record.args),
+                tuple(getattr(record, name, None) for name in CONTEXT))
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and record.created - entry[0] < self.window:
+                entry[1] += 1
+                SUPPRESSED.inc()
+                return False
+
+            if entry is not None and entry[1] > 0:
+                record.repeated = entry[1]
+            self.seen[key] = [record.created, 0]
+            if len(self.seen) > 1000:
+                self._expire(record.created)
+        return True
+
+    def _expire (self, now):
+        # forget messages that are out of the window. Called with the lock held
+        for (key, entry) in self.seen.items():
+            if now - entry[0] >= self.window:
+                del self.seen[key]
+
+
+def _stable (args):
+    # the arguments of a message, with exceptions, whose text often includes
+    #   addresses or counts that change every time, reduced to their type
+    if not isinstance(args, tuple):
+        return None
+    return tuple(type(arg).__name__ if isinstance(arg, BaseException) else arg
+            for arg in args)
+
+
+class Formatter (logging.Formatter):
+
+    def __init__ (self, json_lines=False):
+        logging.Formatter.__init__(self)
+        self.json_lines = json_lines
+
+    def format (self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += '\n' + self.formatException(record.exc_info)
+        repeated = getattr(record, 'repeated', 0)
+
+        if self.json_lines:
+            fields = {
+                    'time': record.created,
+                    'level': record.levelname,
+                    'logger': record.name,
+                    'message': message,
+                    }
+            for name in CONTEXT:
+                if getattr(record, name, None) is not None:
+                    fields[name] = getattr(record, name)
+            if repeated > 0:
+                fields['repeated'] = repeated
+            return json.dumps(fields, sort_keys=True)
+
+        line = time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(record.created))
+        line += ".%03d " % record.msecs + record.levelname
+        for name in CONTEXT:
+            if getattr(record, name, None) is not None:
+                line += ' ' + name + '=' + '%s' % (getattr(record, name),)
+        line += ': ' + message
+        if repeated > 0:
+            line += " (" + str(repeated) + " repeats suppressed)"
+        return line
+
+
+class BackgroundHandler (logging.Handler):
+
+    def __init__ (self, stream=sys.stdout, max_pending=MAX_PENDING):
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.cond = threading.Condition()
+        # whether the writer has records it hasn't finished writing
+        self.busy = False
+        self.dropped = 0
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def emit (self, record):
+        with self.cond:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                DROPPED.inc()
+                return
+            self.pending.append(record)
+            self.cond.notify()
+
+    def flush (self):
+        # wait, briefly, for the writer to catch up. Called at exit
+        deadline = time.time() + FLUSH_TIMEOUT
+        with self.cond:
+            while (len(self.pending) > 0 or self.busy) and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+
+    def _run (self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                records = list(self.pending)
+                self.pending.clear()
+                dropped = self.dropped
+                self.dropped = 0
+                self.busy = True
+
+            lines = []
+            if dropped > 0:
+                lines.append(str(dropped) + " log records dropped, the writer fell behind")
+            for record in records:
+                try:
+                    line = self.format(record)
+                    if isinstance(line, unicode):
+                        line = line.encode('utf-8')
+                    lines.append(line)
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except (IOError, ValueError):
+                pass
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
@@ -0,0 +1,172 @@
+# Counters and histograms for watching the controller under load
+#
+# Metrics are registered once at import time by the modules that update them
+#   and rendered in the Prometheus text format, either served over HTTP by
+#   MetricsServer or written out periodically by SnapshotWriter.
+#
+# Updates take no lock. Each metric is updated from one thread in practice,
+#   and an occasional lost increment is an acceptable price for keeping them
+#   off the hot path.
+
+import os
+import time
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+PREFIX = 'apollito_'
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+        0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+# logpipe counts its own drops here, so this can't import it
+log = logging.getLogger('apollito.metrics')
+
+
+class Counter ():
+
+    def __init__ (self, name, help, function=None):
+        # function, if given, is called for the value at render time, for
+        #   counts kept elsewhere. It must only ever go up
+        self.name = PREFIX + name
+        self.help = help
+        self.value = 0
+        self.function = function
+        REGISTRY.append(self)
+
+    def inc (self, amount=1):
+        self.value += amount
+
+    def render (self):
+        value = self.value
+        if self.function is not None:
+            value = self.function()
+        return ['# HELP ' + self.name + ' ' + self.help,
+                '# TYPE ' + self.name + ' counter',
+                self.name + ' ' + _number(value)]
+
+
+class Gauge ():
+
+    def __init__ (self, name, help, function=None):
+        # function, if given, is called for the value at render time
+        self.name = PREFIX + name
+        self.help = help
+        self.value = 0
+        self.function = function
+        REGISTRY.append(self)
+
+    def set (self, value):
+        self.value = value
+
+    def render (self):
+        value = self.value
+        if self.function is not None:
+            value = self.function()
+        return ['# HELP ' + self.name + ' ' + self.help,
+                '# TYPE ' + self.name + ' gauge',
+                self.name + ' ' + _number(value)]
+
+
+class Histogram ():
+
+    def __init__ (self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.buckets = buckets
+        # counts[i] is the number of observations in bucket i, the last one
+        #   is everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        REGISTRY.append(self)
+
+    def observe (self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time (self, start):
+        # observe the time since start
+        self.observe(time.time() - start)
+
+    def render (self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                '# TYPE ' + self.name + ' histogram']
+        total = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            total += count
+            lines.append(self.name + '_bucket{le="' + _number(bound) + '"} ' + str(total))
+        total += self.counts[-1]
+        lines.append(self.name + '_bucket{le="+Inf"} ' + str(total))
+        lines.append(self.name + '_sum ' + _number(self.sum))
+        lines.append(self.name + '_count ' + str(total))
+        return lines
+
+
+def _number (value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render ():
+    # every registered metric in the Prometheus text format
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer (threading.Thread):
+    # serves render() on http://<host>:<port>/metrics, only to this machine
+    #   unless another host to listen on is given
+
+    def __init__ (self, port, host='localhost'):
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        self.start()
+
+    def run (self):
+        self.server.serve_forever()
+
+
+class _MetricsHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message (self, format, *args):
+        pass
+
+    def do_GET (self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SnapshotWriter (threading.Thread):
+    # writes render() to a file every interval seconds. The file is replaced
+    #   atomically so readers never see a partial snapshot
+
+    def __init__ (self, path, interval=10.0):
+        super(SnapshotWriter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.start()
+
+    def run (self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with open(self.path + '.tmp', 'w') as f:
+                    f.write(render())
+                os.rename(self.path + '.tmp', self.path)
+            except (IOError, OSError), e:
+                log.error("Failure to write metrics snapshot: %s", e)
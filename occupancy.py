@@ -0,0 +1,83 @@
+# Learning each room's absence timeout from how its lights get turned back on
+#
+# OccupancyModel keeps a scale factor for the absence timeout of one room in
+#   each hour of the week. After the lights go off for lack of presence, the
+#   next time someone turns up decides which way the scale for the hour the
+#   room emptied moves:
+#     - back within REGRET_WINDOW seconds, by presence or a button press, and
+#       the lights went off on someone still there. The timeout grows
+#     - later than that, and the room really was empty. The timeout shrinks
+#   so rooms that reliably empty at some hour turn off sooner then, and rooms
+#   where the scanner misses people keep their lights on longer.
+#
+# The model only does work when the lights go off or someone returns, not per
+#   packet, and only keeps the hours that have moved away from the base
+#   timeout, so it costs next to nothing in rooms that don't need it.
+
+import time
+
+# seconds after an automatic off in which someone turning up means the off
+#   was wrong
+REGRET_WINDOW = 5*60
+GROW = 1.5
+SHRINK = 0.9
+MIN_SCALE = 0.5
+MAX_SCALE = 4.0
+
+
+def slot (now):
+    # hour of the week, in local time
+    t = time.localtime(now)
+    return t.tm_wday*24 + t.tm_hour
+
+
+class OccupancyModel (object):
+    __slots__ = ('scales', 'off_time', 'off_slot', 'regrets')
+
+    def __init__ (self):
+        # slot: scale, for the slots that aren't 1.0
+        self.scales = {}
+        # when and in which slot the lights last went off automatically, 0
+        #   once someone has been back since
+        self.off_time = 0
+        self.off_slot = 0
+        self.regrets = 0
+
+    def timeout (self, base, now):
+        # the absence timeout for an absence starting at now
+        return int(round(base * self.scales.get(slot(now), 1.0)))
+
+    def on_auto_off (self, absence_start, now):
+        # the lights went off at now for an absence that started at
+        #   absence_start
+        self.off_time = now
+        self.off_slot = slot(absence_start)
+
+    def on_return (self, now):
+        # someone turned up, seen or by pressing a button
+        if self.off_time == 0:
+            return
+        scale = self.scales.get(self.off_slot, 1.0)
+        if now - self.off_time <= REGRET_WINDOW:
+            scale = min(scale * GROW, MAX_SCALE)
+            self.regrets += 1
+        else:
+            scale = max(scale * SHRINK, MIN_SCALE)
+        if abs(scale - 1.0) < 0.01:
+            self.scales.pop(self.off_slot, None)
+        else:
+            self.scales[self.off_slot] = scale
+        self.off_time = 0
+
+    def state (self):
+        # json friendly, for restore()
+        return {
+                'scales': dict((str(key), value) for (key, value) in self.scales.items()),
+                'off_time': self.off_time,
+                'off_slot': self.off_slot,
+                }
+
+    def restore (self, state):
+        self.scales = dict((int(key), value) for (key, value) in state.get('scales', {}).items())
+        self.off_time = state.get('off_time', 0)
+        self.off_slot = state.get('off_slot', 0)
@@ -4,24 +4,25 @@
 # Must be run as root!
 
 import sys
-from threading import Thread
+
+# the green runtime has to patch the standard library before it is imported
+import green
+if green.requested():
+    green.enable()
+
+import os
 import time
-import Queue
+import select
 
 import RPi.GPIO as GPIO
 from uuid import getnode as get_mac
 
-import urllib2
-import json
-import httplib
 import socket
 
-try:
-    import socketIO_client as sioc
-except ImportError:
-    print('Could not import the socket.io client library.')
-    print('sudo pip install socketIO-client')
-    sys.exit(1)
+import gatd
+import ingest
+import localpath
+import logpipe
 
 USAGE ="""
 Listens for button presses on a Raspberry Pi and POSTs events to GATD
@@ -30,81 +31,128 @@ To perform continuous monitoring, please specify the location being monitored.
 Locations should be specified in the format:
     University|Building|Room
 
+Options:
+    --controller=<host>[:port]
+                also send presses straight to light-control.py running with
+                --local-port on host, default port 47653. The lights react
+                in milliseconds, even while GATD is down
+    --green     run everything on a single thread using gevent
+    --transport=<socketio|udp|zmq>
+    --transport-address=<address>
+                how and where from to receive light actions, as for
+                light-control.py. Default socketio, from GATD
+    --queue=<file>
+                where to keep presses until they're posted to GATD, default
+                /var/lib/apollito/presses.json
+    --no-prompt exit rather than ask for a location if none is given. This is
+                the default when not run from a terminal
+
 The following locations have been seen historically:"""
 LOCATION = ""
 
 BUTTON_PROFILE_ID = '9YWtcF3MFW'
-BUTTON_GET_ADDR = 'http://gatd.eecs.umich.edu:8085/explore/profile/' + BUTTON_PROFILE_ID
-BUTTON_POST_ADDR = 'http://gatd.eecs.umich.edu:8081/' + BUTTON_PROFILE_ID
+BUTTON_POST_ADDR = gatd.POST_ADDR + BUTTON_PROFILE_ID
 
 LIGHT_PROFILE_ID = 'UbkhN72jvp'
 
+BUTTON_POST_QUEUE = None
+# presses waiting to be posted to GATD
+PRESS_JOURNAL = '/var/lib/apollito/presses.json'
+
 BTN_PIN = 25
 LIGHT_PIN = 24
+# seconds the button has to stay down for a press to count. I've been
+#   getting a lot of false positives for whatever reason
+CONFIRM_DELAY = 0.1
+# seconds after a press during which edges are taken as bouncing, or the
+#   button not yet released (multiple messages is acceptable but undesirable)
+LOCKOUT = 1.0
 # gets the mac address of the device, in hex, and cuts out the prepended 0x
 #   and appended L
 DEV_MAC_ADDR = hex(get_mac())[2:-1]
 
+log = logpipe.get('override')
+
 def main():
-    global BTN_PIN, LIGHT_PIN, DEV_MAC_ADDR, LOCATION, LIGHT_PROFILE_ID
+    global BTN_PIN, LIGHT_PIN, DEV_MAC_ADDR, LOCATION, LIGHT_PROFILE_ID, BUTTON_POST_QUEUE
+
+    logpipe.setup()
+
+    transport = get_option('transport', 'socketio')
+    if transport not in ingest.TRANSPORTS:
+        print("Unknown transport: " + transport)
+        sys.exit(1)
 
     # get location from the user
     LOCATION = get_location()
-    print("Running button override at " + LOCATION)
+    log.info("Running button override at " + LOCATION)
 
     # setup GPIO pin
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(BTN_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
     GPIO.setup(LIGHT_PIN, GPIO.OUT)
 
-    # start thread to receive data from GATD
+    # receive light actions from GATD, or another transport, to show on the
+    #   LED
     query = {'location_str': LOCATION}
-    message_queue = Queue.Queue()
-    ReceiverThread(LIGHT_PROFILE_ID, query, 'presence', message_queue)
+    ingest.start(transport, get_option('transport-address'),
+            [(LIGHT_PROFILE_ID, query, 'light')], LightIndicator(LIGHT_PIN))
 
-    # data to be used is constant. Note that a timestamp is automatically
-    #   appended
-    data = {
-            'location_str': LOCATION,
-            'device_id': DEV_MAC_ADDR,
-            'button_id': BTN_PIN
-            }
+    # presses are posted to GATD from a background thread, which retries
+    #   while GATD can't be reached. Until then they're kept on disk too, so
+    #   a restart or power cut doesn't lose them
+    BUTTON_POST_QUEUE = PressQueue(BUTTON_POST_ADDR,
+            get_option('queue', PRESS_JOURNAL))
 
-    while True:
-        # wait for a button press
-        GPIO.wait_for_edge(BTN_PIN, GPIO.FALLING)
-
-        # check that the button is truly low. I've been getting a lot of false
-        #   positives for whatever reason
-        time.sleep(0.1)
-        if GPIO.input(BTN_PIN) != 0:
-            continue
+    # and sent straight to the controller as well, if it's known
+    controller = None
+    if get_option('controller') is not None:
+        controller = localpath.Sender(*localpath.parse_address(get_option('controller')))
 
-        # transmit message to GATD
-        print("Button Pressed!")
+    button = Button(BTN_PIN)
+    while True:
+        pressed_at = button.wait()
+        log.info("Button Pressed!")
+
+        # the controller recognizes the copies of one press by pressed_at.
+        #   Note that GATD appends its own timestamp
+        data = {
+                'location_str': LOCATION,
+                'device_id': DEV_MAC_ADDR,
+                'button_id': BTN_PIN,
+                'pressed_at': pressed_at,
+                }
+        if controller is not None:
+            # the controller sorts packets by profile, as GATD does
+            controller.send(dict(data, profile_id=BUTTON_PROFILE_ID))
         post_to_gatd(data)
 
-        # don't send another message for 1 second to ensure there is no
-        #   bouncing and that the button has been released (multiple messages
-        #   is acceptable but undesirable)
-        time.sleep(1)
-
 def post_to_gatd(data):
-    global BUTTON_POST_ADDR
+    global BUTTON_POST_QUEUE
 
-    try:
-        req = urllib2.Request(BUTTON_POST_ADDR)
-        req.add_header('Content-Type', 'application/json')
-        response = urllib2.urlopen(req, json.dumps(data))
-    except (httplib.BadStatusLine, urllib2.URLError), e:
-        # ignore error and carry on
-        print("Failure to POST to GATD: " + str(e))
+    # queue the record, it gets posted by a background thread so the button
+    #   never waits on GATD
+    BUTTON_POST_QUEUE.put(data)
+
+def get_option(name, default=None):
+    # returns the value of a --name=value command line option
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
 
 def get_location():
     global USAGE
 
-    # get location selection from user
-    if len(sys.argv) != 2 or sys.argv[1] == '':
+    # options start with --, anything else is the location
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    # get location selection from user, if there is one to ask
+    if len(args) != 1 or args[0] == '':
+        if '--no-prompt' in sys.argv or not sys.stdin.isatty():
+            print("No location given on the command line")
+            sys.exit(1)
         print(USAGE)
 
         # get a list of previously monitored locations
@@ -130,94 +178,87 @@ def get_location():
         else:
             return user_input
     else:
-        return sys.argv[1]
+        return args[0]
 
 def query_gatd_explorer(key):
-    global BUTTON_GET_ADDR
+    global BUTTON_PROFILE_ID
 
-    # query GATD explorer to find scan locations
+    # query GATD explorer, or the cached listing, to find scan locations
     try:
-        req = urllib2.Request(BUTTON_GET_ADDR)
-        response = urllib2.urlopen(req)
-        json_data = json.loads(response.read())
-    except (httplib.BadStatusLine, urllib2.URLError), e:
-        print("Connection to GATD failed: " + str(e))
-        return ['None']
-
-    if key in json_data:
-        return json_data['location_str'].keys()
-    else:
-        return ['None']
-
-
-class ReceiverThread (Thread):
-    SOCKETIO_HOST = 'gatd.eecs.umich.edu'
-    SOCKETIO_PORT = 8082
-    SOCKETIO_NAMESPACE = 'stream'
-
-
-    def __init__(self, profile_id, query, data_type, message_queue):
-        super(ReceiverThread, self).__init__()
-        self.daemon = True
-
-        # init data
-        self.profile_id = profile_id
-        self.data_type = data_type
-        self.message_queue = message_queue
-        self.stream_namespace = None
-
-        # make query. Note that this overrides the profile id with the user's
-        #   choice if specified in query
-        profile_query = {'profile_id': profile_id}
-        self.query = dict(list(profile_query.items()) + list(query.items()))
-
-        # start thread
-        self.start()
-
-    def run(self):
+        return gatd.explore(BUTTON_PROFILE_ID, key)
+    except gatd.ERRORS, e:
+        log.warning("Connection to GATD failed: %s", e)
+        return []
+
+
+class Button ():
+    # debounced presses of the button on pin. RPi.GPIO reports falling edges
+    #   from its own thread. They are passed over a pipe, so the main loop
+    #   waits on them with select() rather than sleeping, under either
+    #   runtime
+
+    def __init__ (self, pin):
+        self.pin = pin
+        (self.edge_r, self.edge_w) = os.pipe()
+        # time of an edge waiting to be confirmed, or None
+        self.pending = None
+        self.last_press = 0
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback=self._edge)
+
+    def _edge (self, channel):
+        # called on the RPi.GPIO thread
+        os.write(self.edge_w, 'e')
+
+    def wait (self):
+        # blocks until the next press, returns when it was made
         while True:
-            try:
-                socketIO = sioc.SocketIO(self.SOCKETIO_HOST, self.SOCKETIO_PORT)
-                self.stream_namespace = socketIO.define(StreamReceiver,
-                        '/{}'.format(self.SOCKETIO_NAMESPACE))
-                self.stream_namespace.set_data(self.query, self.data_type, self.message_queue,
-                        self.stream_namespace)
-                socketIO.wait()
-            except sioc.exceptions.ConnectionError:
-                # ignore error and continue
-                socketIO.disconnect()
-
-
-class StreamReceiver (sioc.BaseNamespace):
-
-    def set_data (self, query, data_type, message_queue, stream_namespace):
-        self.query = query
-        self.data_type = data_type
-        self.message_queue = message_queue
-        self.stream_namespace = stream_namespace
-
-    def on_reconnect (self):
-        if 'time' in query:
-            del query['time']
-        self.stream_namespace.emit('query', self.query)
-
-    def on_connect (self):
-        self.stream_namespace.emit('query', self.query)
-
-    def on_data (self, *args):
-        # data received from gatd. Push to msg_q
-        #self.message_queue.put([self.data_type, args[0]])
-
-        # Since I only have one thread, I'm just going to do special functions here
-        global LIGHT_PIN
-        data = args[0]
+            # nothing to do until an edge arrives, unless one is waiting to
+            #   be confirmed
+            timeout = None
+            if self.pending is not None:
+                timeout = max(0, self.pending + CONFIRM_DELAY - time.time())
+            (readable, _, _) = select.select([self.edge_r], [], [], timeout)
+            now = time.time()
+
+            if len(readable) > 0:
+                os.read(self.edge_r, 512)
+                if self.pending is None and now - self.last_press > LOCKOUT:
+                    self.pending = now
+
+            # check that the button is truly low once it has had time to settle
+            if self.pending is not None and now >= self.pending + CONFIRM_DELAY:
+                pressed_at = self.pending
+                self.pending = None
+                if GPIO.input(self.pin) == 0:
+                    self.last_press = pressed_at
+                    return pressed_at
+
+
+class PressQueue (gatd.JournaledPostQueue):
+    # posts each press with how many seconds it waited to be posted, by this
+    #   Pi's clock, so the controller can drop stale presses without comparing
+    #   its clock to ours. The copy sent straight to the controller has no
+    #   wait to speak of and goes without
+
+    def _prepare (self, data):
+        return dict(data, queued_for=round(max(0, time.time() - data['pressed_at']), 3))
+
+
+class LightIndicator ():
+    # stands in for a message queue, showing the state of the lights on the
+    #   LED at pin as light actions arrive
+
+    def __init__ (self, pin):
+        self.pin = pin
+
+    def put (self, item):
+        (data_type, data, recv_time) = item
         if 'action' in data:
             if data['action'] == 'off':
-                GPIO.output(LIGHT_PIN, GPIO.HIGH)
+                GPIO.output(self.pin, GPIO.HIGH)
             else:
-                GPIO.output(LIGHT_PIN, GPIO.LOW)
+                GPIO.output(self.pin, GPIO.LOW)
 
 
 if __name__ == "__main__":
     main()
-
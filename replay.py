@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Replays recorded events through the room decision logic
+#
+# Replayer runs the same routing, RoomController and deadline handling as
+#   the light-control.py main loop, but against a virtual clock taken from the
+#   event receive times and with no sockets, so it runs as fast as the
+#   decisions can be made.
+
+import sys
+import time
+
+import config
+import eventlog
+import occupancy
+import roomcontrol
+import scheduler
+
+USAGE = """
+Replays recorded GATD events through the light control logic
+
+Usage:
+    replay.py <events file> ... [--config=<file>] [--print] [--adaptive]
+              [--location=University|Building|Room ...]
+
+Events files are recordings made by light-control.py --record, or GATD
+exports of the presence, button and command profiles, as for simulate.py.
+
+Options:
+    --config=       the light-control.py --config file the events were
+                    recorded under, for each room's buttons, panel people,
+                    timeouts and GATD profiles
+    --print         print every command as it is made
+    --adaptive      learn every room's absence timeout, see occupancy.py.
+                    Otherwise only rooms configured with adaptive_timeout do
+    --location=     only replay the given location(s). Defaults to every
+                    location seen in the events
+"""
+
+
+class Replayer ():
+
+    def __init__ (self, locations=None, on_command=None, adaptive=False,
+            absence_timeout=None, panel_timeout=None, configuration=None):
+        # locations limits the rooms being controlled. If None, a room is
+        #   created for every location seen. on_command, if given, is called
+        #   with (time, location, command) for every command made. Rooms are
+        #   set up from configuration, a config.Config, as light-control.py
+        #   would set them up, defaulting to the built in one. adaptive gives
+        #   every room an occupancy model, and the timeouts, if given,
+        #   override every room's
+        self.locations = None if locations is None else set(locations)
+        self.on_command = on_command
+        self.configuration = configuration or config.load()
+        self.adaptive = adaptive
+        self.absence_timeout = absence_timeout
+        self.panel_timeout = panel_timeout
+        self.rooms = {}
+        self.timers = scheduler.Scheduler()
+        self.now = 0
+
+        self.events = 0
+        self.commands = 0
+
+    def room (self, location, now):
+        controller = self.rooms.get(location)
+        if controller is None:
+            room_config = self.configuration.room(location)
+            controller = roomcontrol.RoomController(location, room_config.buttons,
+                    room_config.likes,
+                    self.absence_timeout or room_config.absence_timeout,
+                    self.panel_timeout or room_config.panel_timeout)
+            if self.adaptive or room_config.adaptive_timeout:
+                controller.model = occupancy.OccupancyModel()
+            self.rooms[location] = controller
+            self._emit(controller, controller.on_tick(int(round(now))), now)
+            self.timers.schedule(controller, controller.next_deadline())
+        return controller
+
+    def feed (self, recv_time, data_type, pkt):
+        # handle one event received at recv_time
+        self.advance(recv_time)
+        self.events += 1
+
+        # skip packet if it doesn't contain enough data to use
+        if (pkt == None or 'location_str' not in pkt or 'time' not in pkt):
+            return
+
+        # skip packet if not for a monitored location
+        location = pkt['location_str']
+        if self.locations is not None and location not in self.locations:
+            return
+
+        controller = self.room(location, recv_time)
+        self._emit(controller, controller.on_event(data_type, pkt, int(round(recv_time))),
+                recv_time)
+        self.timers.schedule(controller, controller.next_deadline())
+
+    def advance (self, until):
+        # move the virtual clock forward, running every timeout due on the way
+        #   at the time it would have fired. A deadline already behind the
+        #   clock, say one set by an event that arrived late, fires now, as
+        #   the controller's would, and never back in time
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None or deadline > until:
+                break
+            now = max(deadline, self.now)
+            for controller in self.timers.pop_due(deadline):
+                self._emit(controller, controller.on_tick(now), now)
+                self.timers.schedule(controller, controller.next_deadline())
+            self.now = now
+        self.now = max(self.now, until)
+
+    def run (self, events):
+        for (recv_time, data_type, pkt) in events:
+            self.feed(recv_time, data_type, pkt)
+
+    def _emit (self, controller, commands, now):
+        self.commands += len(commands)
+        if self.on_command is not None:
+            for command in commands:
+                self.on_command(now, controller.location, command)
+
+
+def get_option (name, default=None):
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def print_command (now, location, command):
+    mode = "Manual " if command.manual else "Automatic "
+    line = time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(now)) + ": " + location + ": "
+    if command.reason:
+        line += command.reason + ": "
+    print(line + mode + command.device + " " + command.state.lower())
+
+def main ():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) == 0:
+        print(USAGE)
+        sys.exit(1)
+
+    locations = [arg[len('--location='):] for arg in sys.argv[1:]
+            if arg.startswith('--location=')]
+    on_command = print_command if '--print' in sys.argv else None
+
+    try:
+        configuration = config.load(get_option('config'))
+    except config.ConfigError, e:
+        print("Invalid configuration: " + str(e))
+        sys.exit(1)
+
+    replayer = Replayer(locations or None, on_command, '--adaptive' in sys.argv,
+            configuration=configuration)
+    start = time.time()
+    replayer.run(eventlog.read_inputs(args, configuration.profiles._asdict()))
+    elapsed = time.time() - start
+
+    print("Replayed " + str(replayer.events) + " events for " + str(len(replayer.rooms)) +
+            " rooms in " + "%.3f" % elapsed + " seconds")
+    print("Commands: " + str(replayer.commands))
+    models = [controller.model for controller in replayer.rooms.values()
+            if controller.model is not None]
+    if len(models) > 0:
+        regrets = sum(model.regrets for model in models)
+        print("Lights wanted back within " + str(occupancy.REGRET_WINDOW // 60) +
+                " minutes of going off: " + str(regrets))
+    if elapsed > 0:
+        print("Events/sec: " + "%.0f" % (replayer.events / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+# Occupancy based light control decisions
+#
+# RoomController holds the override, absence and panel state for a single
+#   room. It does no I/O of its own: packets and clock ticks go in, and the
+#   actuator commands that should be sent come out. light-control.py wraps it
+#   with sockets and ACME++ objects, but it can just as well be driven offline
+#   from recorded events.
+
+from collections import namedtuple
+
+# (device_id, button_id) of the override buttons
+BUTTONS = [('b827eb0a2b8f', 25)]
+# people who like the panel on. People are named by uniqname, either as a
+#   plain string or as a {uniqname: full name} dict, the same as in the
+#   person_list of presence packets
+PANEL_PEOPLE = [{'samkuo': 'Ye-Sheng Kuo'}]
+
+# lights turn off after this many seconds with no one present
+ABSENCE_TIMEOUT = 10*60
+# the panel turns off after this many seconds without seeing someone who
+#   likes it
+PANEL_TIMEOUT = 30*60
+# length of a temporary override, in minutes
+OVERRIDE_DURATION = 30
+# pressing the button again within this many seconds of an override ending
+#   doubles the next override
+OVERRIDE_REPEAT_WINDOW = 10*60
+# presses remembered per room to recognize one arriving again by another
+#   path, see localpath.py
+RECENT_PRESSES = 4
+# presses queued on the override Pi for more than this many seconds, say
+#   while GATD was down, are too late to act on. The Pi measures the wait by
+#   its own clock and sends it as queued_for, so the two clocks needn't agree
+PRESS_MAX_AGE = 5*60
+
+# a command for a device ('lights' or 'panel') to be set to state ('On' or
+#   'Off'). Manual is True if the state comes from an override, and reason is
+#   a human readable description of what caused the change (possibly empty)
+Command = namedtuple('Command', ['device', 'state', 'manual', 'reason'])
+
+NO_COMMANDS = ()
+
+# light_command values from the command profile:
+#   command: (device, permanent, state, description)
+LIGHT_COMMANDS = {
+        'on':             ('lights', False, 'On',  "Command override! Temporary on"),
+        'off':            ('lights', False, 'Off', "Command override! Temporary off"),
+        'stay_on':        ('lights', True,  'On',  "Command override! Stay on"),
+        'stay_off':       ('lights', True,  'Off', "Command override! Stay off"),
+        'panel_on':       ('panel',  False, 'On',  "Command override! Temporary panel on"),
+        'panel_off':      ('panel',  False, 'Off', "Command override! Temporary panel off"),
+        'panel_stay_on':  ('panel',  True,  'On',  "Command override! Panel stay on"),
+        'panel_stay_off': ('panel',  True,  'Off', "Command override! Panel stay off"),
+        }
+
+
+def person_ids (entry):
+    # the uniqnames named by a person_list entry
+    if isinstance(entry, dict):
+        return entry.keys()
+    return (entry,)
+
+def index_likes (likes):
+    # turns {device: [people who like it on]} into the inverted index
+    #   {uniqname: (devices they like on)}, so the devices a presence packet
+    #   touches are found with one hash lookup per person present
+    index = {}
+    for (device, people) in likes.items():
+        for entry in people:
+            for person in person_ids(entry):
+                if device not in index.get(person, ()):
+                    index[person] = index.get(person, ()) + (device,)
+    return index
+
+# the index for rooms using the default PANEL_PEOPLE, shared between them
+LIKES = index_likes({'panel': PANEL_PEOPLE})
+
+
+def _note (current, reason):
+    # accumulate the reasons for a pending change. None means no change
+    if not current:
+        return reason
+    if not reason:
+        return current
+    return current + "; " + reason
+
+
+def _duration (seconds):
+    if seconds % 60 == 0:
+        return str(int(seconds // 60)) + " minutes"
+    return str(seconds) + " seconds"
+
+
+class RoomController (object):
+    # the slots that make up the room's state, as opposed to its settings
+    STATE = (
+            'temp_override_duration',
+            'absence_start',
+            'absence_wait',
+            'auto_light_state',
+            'temp_override_start',
+            'prev_temp_override_end',
+            'manual_override',
+            'manual_light_state',
+
+            'panel_last_seen',
+            'auto_panel_state',
+            'panel_temp_override_start',
+            'panel_manual_override',
+            'manual_panel_state',
+            )
+
+    __slots__ = (
+            'location', 'buttons', 'likes',
+            'absence_timeout', 'panel_timeout', 'model',
+
+            'temp_override_duration',
+            'absence_start',
+            'absence_wait',
+            'auto_light_state',
+            'temp_override_start',
+            'prev_temp_override_end',
+            'manual_override',
+            'manual_light_state',
+            'light_change',
+            'recent_presses',
+
+            'panel_last_seen',
+            'auto_panel_state',
+            'panel_temp_override_start',
+            'panel_manual_override',
+            'manual_panel_state',
+            'panel_change',
+            )
+
+    def __init__ (self, location, buttons=BUTTONS, likes=LIKES,
+            absence_timeout=ABSENCE_TIMEOUT, panel_timeout=PANEL_TIMEOUT, model=None):
+        # buttons is a set of (device_id, button_id) pairs that act as the
+        #   override button for this room. likes is an index_likes() index of
+        #   who likes which devices on. It isn't copied, so rooms with the
+        #   same preferences can share one. model, if given, is an
+        #   occupancy.OccupancyModel that adapts absence_timeout to the room
+        self.location = location
+        self.buttons = frozenset(buttons)
+        self.likes = likes
+        self.absence_timeout = absence_timeout
+        self.panel_timeout = panel_timeout
+        self.model = model
+
+        self.temp_override_duration = OVERRIDE_DURATION
+
+        self.absence_start = 0
+        # the absence timeout of the current absence
+        self.absence_wait = absence_timeout
+        self.auto_light_state = 'On'
+        self.temp_override_start = 0
+        self.prev_temp_override_end = 0
+        self.manual_override = False
+        self.manual_light_state = 'On'
+        # reason for a pending change of the lights, None if no change. Starts
+        #   out pending so that the initial state is sent
+        self.light_change = ''
+        # (device_id, button_id, pressed_at) of the last few presses
+        self.recent_presses = ()
+
+        self.panel_last_seen = 0
+        self.auto_panel_state = 'Off'
+        self.panel_temp_override_start = 0
+        self.panel_manual_override = False
+        self.manual_panel_state = 'Off'
+        self.panel_change = ''
+
+    def state (self):
+        # a json friendly copy of the room's state, for restore()
+        state = dict((name, getattr(self, name)) for name in self.STATE)
+        if self.model is not None:
+            state['model'] = self.model.state()
+        return state
+
+    def restore (self, state):
+        # carry on from a state() saved earlier, say before a restart. Nothing
+        #   is left pending, see resend()
+        for name in self.STATE:
+            if name in state:
+                setattr(self, name, state[name])
+        if self.model is not None and 'model' in state:
+            self.model.restore(state['model'])
+        self.light_change = None
+        self.panel_change = None
+
+    def resend (self, device):
+        # have the next commands include device ('lights' or 'panel') even if
+        #   its state hasn't changed
+        if device == 'lights':
+            self.light_change = _note(self.light_change, '')
+        else:
+            self.panel_change = _note(self.panel_change, '')
+
+    def light_state (self):
+        # returns the (state, manual) the lights should currently be in
+        if self.manual_override or self.temp_override_start != 0:
+            return (self.manual_light_state, True)
+        return (self.auto_light_state, False)
+
+    def panel_state (self):
+        # returns the (state, manual) the panel should currently be in
+        if self.panel_manual_override or self.panel_temp_override_start != 0:
+            return (self.manual_panel_state, True)
+        return (self.auto_panel_state, False)
+
+    def next_deadline (self):
+        # returns the earliest time at which on_tick would change something,
+        #   or None if nothing is pending. Timeouts fire once the time since
+        #   they started is strictly greater than their length
+        deadlines = []
+        if self.temp_override_start != 0:
+            deadlines.append(self.temp_override_start + self.temp_override_duration*60 + 1)
+        if self.panel_temp_override_start != 0:
+            deadlines.append(self.panel_temp_override_start + self.temp_override_duration*60 + 1)
+        if self.absence_start != 0:
+            deadlines.append(self.absence_start + self.absence_wait + 1)
+        if self.auto_panel_state == 'On':
+            deadlines.append(self.panel_last_seen + self.panel_timeout + 1)
+        if len(deadlines) == 0:
+            return None
+        return min(deadlines)
+
+    def on_tick (self, now):
+        # handle timeouts, returns any resulting commands
+        self._check_timeouts(now)
+        return self._commands()
+
+    def on_event (self, kind, pkt, now):
+        # handle a packet of the given kind ('button', 'presence' or
+        #   'command'), returns any resulting commands
+        self._check_timeouts(now)
+
+        # skip packet if it doesn't contain enough data to use
+        if 'time' not in pkt:
+            return self._commands()
+
+        if kind == 'button':
+            self._on_button(pkt, now)
+        elif kind == 'presence':
+            self._on_presence(pkt, now)
+        elif kind == 'command':
+            self._on_command(pkt, now)
+
+        return self._commands()
+
+    def _commands (self):
+        if self.light_change is None and self.panel_change is None:
+            return NO_COMMANDS
+
+        commands = []
+        if self.light_change is not None:
+            (state, manual) = self.light_state()
+            commands.append(Command('lights', state, manual, self.light_change))
+            self.light_change = None
+        if self.panel_change is not None:
+            (state, manual) = self.panel_state()
+            commands.append(Command('panel', state, manual, self.panel_change))
+            self.panel_change = None
+        return commands
+
+    def _check_timeouts (self, now):
+        # turn off override mode if it's been a full duration
+        if (self.temp_override_start != 0 and
+                (now - self.temp_override_start) > self.temp_override_duration*60):
+            self.temp_override_start = 0
+            self.prev_temp_override_end = now
+            self.light_change = _note(self.light_change, "Override lights timed out")
+        if (self.panel_temp_override_start != 0 and
+                (now - self.panel_temp_override_start) > self.temp_override_duration*60):
+            self.panel_temp_override_start = 0
+            # no need to do the backoff stuff
+            self.panel_change = _note(self.panel_change, "Override panel timed out")
+
+        # turn off lights if it's been absence_wait with no people
+        if self.absence_start != 0 and (now - self.absence_start) > self.absence_wait:
+            if (self.model is not None and not self.manual_override and
+                    self.temp_override_start == 0):
+                self.model.on_auto_off(self.absence_start, now)
+            self.absence_start = 0
+            self.auto_light_state = 'Off'
+            self.light_change = _note(self.light_change,
+                    "No one seen for " + _duration(self.absence_wait))
+
+        # turn off the panel too
+        if self.auto_panel_state == 'On':
+            if (now - self.panel_last_seen) > self.panel_timeout:
+                self.auto_panel_state = 'Off'
+                self.panel_change = _note(self.panel_change, '')
+
+    def _on_button (self, pkt, now):
+        # Button data
+        # This data comes in single packets identifying that a button press
+        #   has occurred. On the appropriate button press, light control will
+        #   be overriden for a half-hour and the lights will be turned on
+        if (pkt.get('device_id'), pkt.get('button_id')) not in self.buttons:
+            return
+
+        # a press sent both directly and through GATD arrives twice
+        if 'pressed_at' in pkt:
+            press = (pkt['device_id'], pkt['button_id'], pkt['pressed_at'])
+            if press in self.recent_presses:
+                return
+            self.recent_presses = self.recent_presses[1 - RECENT_PRESSES:] + (press,)
+            if pkt.get('queued_for', 0) > PRESS_MAX_AGE:
+                return
+
+        # this is the right button, do action based on state
+        if self.manual_override == False:
+            # someone wanted the lights, perhaps right after they went off
+            if self.model is not None:
+                self.model.on_return(now)
+
+            # determine how long the duration should be
+            if (self.prev_temp_override_end != 0 and
+                    (now - self.prev_temp_override_end) < OVERRIDE_REPEAT_WINDOW):
+                # if the button gets pressed again within 10 minutes of the
+                #   timeout, double the duration of the temporary override
+                self.temp_override_duration *= 2
+            else:
+                # otherwise return to a normal duration
+                self.temp_override_duration = OVERRIDE_DURATION
+
+            # enable lights for some time
+            self.temp_override_start = now
+            self.prev_temp_override_end = 0
+            self.manual_light_state = 'On'
+            self.light_change = _note(self.light_change,
+                    "Button Override! Lights on for " +
+                    str(self.temp_override_duration) + " minutes")
+        else:
+            # resume automatic control
+            self.temp_override_start = 0
+            self.manual_override = False
+            self.manual_light_state = 'On'
+            self.light_change = _note(self.light_change, "Button Override! Control resumed")
+
+    def _on_presence (self, pkt, now):
+        # Presence data
+        # This data comes from Whereabouts in single packets containing a list
+        #   of the people current present
+        if 'person_list' not in pkt:
+            return
+
+        person_list = pkt['person_list']
+        if len(person_list) == 0:
+            # no one is here! start a count and wait for 10 minutes
+            #   before actually turning off the lights
+            if self.absence_start == 0 and self.auto_light_state == 'On':
+                self.absence_start = now
+                if self.model is None:
+                    self.absence_wait = self.absence_timeout
+                else:
+                    self.absence_wait = self.model.timeout(self.absence_timeout, now)
+            return
+
+        # someone is here! make sure the lights are on and stop
+        #   any running counter
+        self.absence_start = 0
+        if self.auto_light_state == 'Off':
+            self.auto_light_state = 'On'
+            self.light_change = _note(self.light_change, "Someone is seen!")
+            if self.model is not None:
+                self.model.on_return(now)
+
+        # turn on or off light panel based on people who like it
+        if 'panel' in self._liked(person_list):
+            self.panel_last_seen = now
+            if self.auto_panel_state != 'On':
+                self.auto_panel_state = 'On'
+                self.panel_change = _note(self.panel_change, '')
+
+    def _liked (self, person_list):
+        # the devices liked by anyone in person_list, possibly repeated
+        liked = ()
+        if len(self.likes) == 0:
+            return liked
+        get = self.likes.get
+        for entry in person_list:
+            try:
+                devices = get(entry)
+            except TypeError:
+                # a {uniqname: full name} dict
+                devices = ()
+                for person in entry:
+                    devices += get(person, ())
+            if devices:
+                liked += devices
+        return liked
+
+    def _on_command (self, pkt, now):
+        # Command data
+        # This data comes from commands sent by the 4908 script. Commands
+        #   include 'stay_on', 'stay_off', 'resume', 'on', and 'off' as well
+        #   as their panel equivalents
+        if 'light_command' not in pkt:
+            return
+        light_command = pkt['light_command']
+
+        if light_command == 'resume':
+            # turn off manual_control
+            self.temp_override_start = 0
+            self.manual_override = False
+            self.panel_temp_override_start = 0
+            self.panel_manual_override = False
+            self.light_change = _note(self.light_change, "Command override! Resume control")
+            self.panel_change = _note(self.panel_change, '')
+            return
+
+        if light_command not in LIGHT_COMMANDS:
+            return
+        (device, permanent, state, description) = LIGHT_COMMANDS[light_command]
+
+        # temporary overrides run for a duration, permanent ones until a resume
+        override_start = 0 if permanent else now
+        if device == 'lights':
+            self.temp_override_start = override_start
+            self.manual_override = permanent
+            self.manual_light_state = state
+            self.light_change = _note(self.light_change, description)
+        else:
+            self.panel_temp_override_start = override_start
+            self.panel_manual_override = permanent
+            self.manual_panel_state = state
+            self.panel_change = _note(self.panel_change, description)
+
+
+class Router ():
+    # finds the room a packet is for. Rooms are indexed by location, and
+    #   buttons by (location, device_id, button_id), so routing a packet is a
+    #   single dict lookup whatever the number of rooms
+
+    def __init__ (self):
+        self.rooms = {}
+        self.buttons = {}
+
+    def add (self, location, room, buttons=BUTTONS):
+        # adding a location again replaces its room and buttons
+        self.remove(location)
+        self.rooms[location] = room
+        for (device_id, button_id) in buttons:
+            self.buttons[(location, device_id, button_id)] = room
+
+    def remove (self, location):
+        self.rooms.pop(location, None)
+        for key in [key for key in self.buttons if key[0] == location]:
+            del self.buttons[key]
+
+    def route (self, data_type, pkt):
+        # returns the room a packet is for, or None if no room wants it
+        if data_type == 'button':
+            return self.buttons.get((pkt.get('location_str'), pkt.get('device_id'),
+                pkt.get('button_id')))
+        return self.rooms.get(pkt.get('location_str'))
+
+    def query (self, data_type):
+        # the stream query that asks GATD for just the packets of data_type
+        #   some room wants
+        query = {'location_str': _match_any(self.rooms.keys())}
+        if data_type == 'button':
+            query['device_id'] = _match_any(set(key[1] for key in self.buttons))
+        return query
+
+
+def _match_any (values):
+    # query value matching any of values
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    return {'$in': values}
@@ -0,0 +1,231 @@
+# Deadline scheduling for the control loop
+#
+# Scheduler keeps a heap of (deadline, key) pairs so the control loop can
+#   sleep exactly until the next timeout instead of waking up every second
+#   to check every room. EventQueue is a queue whose get() sleeps in select()
+#   until either an item arrives or the timeout passes. Queue.Queue can't be
+#   used for this: in python 2 a get() with a timeout polls in short sleeps.
+#
+# IngestQueue is the EventQueue the stream receivers feed. It is bounded, and
+#   sorts packets into lanes: button presses, commands and ACME++ replies are
+#   handed out first, and a presence snapshot replaces any still waiting for
+#   the same location, since only the latest one matters. A flood of
+#   presence traffic then costs one slot per location and never delays a
+#   human pressing a button.
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import select
+import threading
+import Queue
+from collections import deque, OrderedDict
+
+
+class Scheduler ():
+
+    def __init__ (self):
+        # entries are (deadline, sequence, key). Rescheduling a key leaves its
+        #   old entry in the heap, it is skipped when it reaches the top
+        self.heap = []
+        self.deadlines = {}
+        self.sequence = 0
+
+    def __len__ (self):
+        return len(self.deadlines)
+
+    def schedule (self, key, deadline):
+        # set the deadline for key, replacing any previous one. A deadline of
+        #   None cancels it
+        if deadline is None:
+            self.cancel(key)
+            return
+        if self.deadlines.get(key) == deadline:
+            return
+
+        self.deadlines[key] = deadline
+        self.sequence += 1
+        heapq.heappush(self.heap, (deadline, self.sequence, key))
+
+        # don't let stale entries pile up if keys are rescheduled constantly
+        if len(self.heap) > 2*len(self.deadlines) + 64:
+            self._compact()
+
+    def cancel (self, key):
+        self.deadlines.pop(key, None)
+
+    def next_deadline (self):
+        # returns the earliest deadline, or None if nothing is scheduled
+        self._skip_stale()
+        if len(self.heap) == 0:
+            return None
+        return self.heap[0][0]
+
+    def pop_due (self, now):
+        # remove and return the keys whose deadline is at or before now
+        due = []
+        self._skip_stale()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            (deadline, sequence, key) = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
+            self._skip_stale()
+        return due
+
+    def _skip_stale (self):
+        heap = self.heap
+        while len(heap) > 0 and self.deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _compact (self):
+        # keep a single live entry per key
+        heap = []
+        seen = set()
+        for entry in self.heap:
+            key = entry[2]
+            if key not in seen and self.deadlines.get(key) == entry[0]:
+                seen.add(key)
+                heap.append(entry)
+        heapq.heapify(heap)
+        self.heap = heap
+
+
+class EventQueue ():
+
+    def __init__ (self):
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.waiting = False
+
+        # the consumer sleeps in select() on this pipe, producers write a
+        #   byte to it to wake the consumer up
+        (self.wake_r, self.wake_w) = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __del__ (self):
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def qsize (self):
+        return len(self.items)
+
+    def put (self, item):
+        with self.lock:
+            self._push(item)
+            wake = self.waiting
+            self.waiting = False
+        if wake:
+            self._wake()
+
+    def get (self, timeout=None):
+        # returns the next item. Raises Queue.Empty if no item arrives within
+        #   timeout seconds, blocks forever if timeout is None
+        if timeout is not None:
+            end_time = time.time() + timeout
+
+        while True:
+            with self.lock:
+                if self.qsize() > 0:
+                    self.waiting = False
+                    return self._pop()
+                self.waiting = True
+
+            remaining = None
+            if timeout is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    with self.lock:
+                        self.waiting = False
+                    raise Queue.Empty
+
+            try:
+                select.select([self.wake_r], [], [], remaining)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            self._drain()
+
+    def _push (self, item):
+        # called with the lock held
+        self.items.append(item)
+
+    def _pop (self):
+        # called with the lock held, when the queue isn't empty
+        return self.items.popleft()
+
+    def _wake (self):
+        try:
+            os.write(self.wake_w, b'\x00')
+        except OSError, e:
+            # pipe already full, the consumer will wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain (self):
+        try:
+            while len(os.read(self.wake_r, 4096)) == 4096:
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class IngestQueue (EventQueue):
+    # items are [data_type, pkt, recv_time] lists
+    PRIORITY_TYPES = ('button', 'command', 'ack', 'reload')
+    # most items waiting in each of the priority and other lanes, and most
+    #   locations with a presence snapshot waiting. Past these, new items are
+    #   dropped
+    MAX_PRIORITY = 1000
+    MAX_OTHER = 1000
+    MAX_PRESENCE = 10000
+
+    def __init__ (self):
+        EventQueue.__init__(self)
+        self.priority = deque()
+        # location: latest presence item, oldest first
+        self.presence = OrderedDict()
+        # anything else, like presence without a location
+        self.items = deque()
+
+        # presence snapshots replaced by a newer one, and items dropped for
+        #   lack of room
+        self.coalesced = 0
+        self.dropped = 0
+
+    def qsize (self):
+        return len(self.priority) + len(self.presence) + len(self.items)
+
+    def _push (self, item):
+        data_type = item[0]
+        if data_type in self.PRIORITY_TYPES:
+            self._append(self.priority, item, self.MAX_PRIORITY)
+        elif data_type == 'presence' and isinstance(item[1], dict) and 'location_str' in item[1]:
+            location = item[1]['location_str']
+            if location in self.presence:
+                # replacing keeps its place in line
+                self.presence[location] = item
+                self.coalesced += 1
+            elif len(self.presence) >= self.MAX_PRESENCE:
+                self.dropped += 1
+            else:
+                self.presence[location] = item
+        else:
+            self._append(self.items, item, self.MAX_OTHER)
+
+    def _append (self, lane, item, limit):
+        if len(lane) >= limit:
+            self.dropped += 1
+        else:
+            lane.append(item)
+
+    def _pop (self):
+        if len(self.priority) > 0:
+            return self.priority.popleft()
+        if len(self.presence) > 0:
+            return self.presence.popitem(last=False)[1]
+        return self.items.popleft()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+# Batch simulation of light control policies over recorded events
+#
+# Runs recordings or GATD exports (see eventlog.py), or synthetic traffic,
+#   through one Replayer per policy variant in a single pass, and reports how
+#   long each variant would have kept the lights and panels on, how often it
+#   switched them, how often it turned the lights off just before someone
+#   wanted them back, and how often people overrode it. Decisions are made by
+#   the same RoomController as light-control.py, so they are the ones the
+#   controller would have made.
+#
+# Events are read CHUNK_EVENTS at a time. Only the commands made during the
+#   current chunk are kept, and they are folded into running per room totals
+#   with numpy, so a year of a building's traffic needs no more memory than a
+#   day of it. GATD exports stored as a single json array are the exception,
+#   and are read whole.
+
+import csv
+import sys
+import time
+import itertools
+
+import config
+import eventlog
+import occupancy
+from replay import Replayer
+
+try:
+    import numpy
+except ImportError:
+    print('Could not import numpy.')
+    print('sudo pip install numpy')
+    sys.exit(1)
+
+USAGE = """
+Simulates light control policies over recorded GATD events
+
+Usage:
+    simulate.py <events file> ... [--config=<file>] [--absence=S,...] [--panel=S,...]
+                [--adaptive] [--csv=<file>]
+    simulate.py --synthetic=<rooms> [--days=D] [...]
+
+Events files can be any mix of, optionally gzip compressed (.gz):
+    recordings made by light-control.py --record, one [recv_time, data_type,
+        pkt] list per line
+    GATD exports of the presence, button and command profiles, a json array
+        of records or one record per line, each with its profile_id and its
+        GATD time in milliseconds
+and are merged in time order.
+
+Options:
+    --config=       the light-control.py --config file the events were
+                    recorded under, for each room's buttons, panel people,
+                    timeouts and GATD profiles
+    --absence=      comma separated absence timeouts to try, in seconds.
+                    Default each room's own, 600 unless configured
+    --panel=        comma separated panel timeouts to try, in seconds.
+                    Default each room's own, 1800 unless configured
+    --adaptive      also try every variant with adaptive absence timeouts in
+                    every room
+    --csv=          write the results for every room and variant to file
+    --synthetic=    simulate this many rooms of synthetic traffic instead of
+                    a recording
+    --days=         days of synthetic traffic, default 7
+"""
+
+# events read from disk at a time
+CHUNK_EVENTS = 100000
+DEVICES = ('lights', 'panel')
+# packets that override the automatic control
+OVERRIDE_TYPES = ('button', 'command')
+
+
+def get_option (name, default):
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def _grow (values, size, fill):
+    # values padded with fill to at least size
+    if len(values) >= size:
+        return values
+    return numpy.append(values, numpy.full(size - len(values), fill, values.dtype))
+
+
+class Rooms ():
+    # the rooms seen so far, numbered in order of appearance
+
+    def __init__ (self):
+        self.numbers = {}
+        self.locations = []
+        # when each room was first seen
+        self.starts = []
+        self.overrides = numpy.zeros(0, numpy.int64)
+
+    def number (self, location, now):
+        number = self.numbers.get(location)
+        if number is None:
+            number = len(self.locations)
+            self.numbers[location] = number
+            self.locations.append(location)
+            self.starts.append(now)
+        return number
+
+    def count_overrides (self, events):
+        numbers = [self.number(pkt['location_str'], recv_time)
+                for (recv_time, data_type, pkt) in events
+                if data_type in OVERRIDE_TYPES and pkt is not None and
+                        'location_str' in pkt and 'time' in pkt]
+        self.overrides = _grow(self.overrides, len(self.locations), 0)
+        if len(numbers) > 0:
+            self.overrides += numpy.bincount(numbers, minlength=len(self.locations))
+
+
+class Variant ():
+    # one policy being simulated, and its running totals for every
+    #   (room, device) key, room number * len(DEVICES) + device index
+
+    def __init__ (self, name, rooms, **settings):
+        self.name = name
+        self.rooms = rooms
+        self.replayer = Replayer(on_command=self.command, **settings)
+
+        # commands made during the current chunk
+        self.times = []
+        self.keys = []
+        self.states = []
+
+        # the state last switched to (-1 before the first command) and when
+        self.state = numpy.zeros(0, numpy.int8)
+        self.since = numpy.zeros(0)
+        # seconds on, switches, and offs followed by an on within
+        #   occupancy.REGRET_WINDOW
+        self.on_time = numpy.zeros(0)
+        self.switches = numpy.zeros(0, numpy.int64)
+        self.false_offs = numpy.zeros(0, numpy.int64)
+
+    def command (self, now, location, command):
+        self.times.append(now)
+        self.keys.append(self.rooms.number(location, now)*len(DEVICES) +
+                DEVICES.index(command.device))
+        self.states.append(command.state == 'On')
+
+    def grow (self):
+        size = len(self.rooms.locations) * len(DEVICES)
+        self.state = _grow(self.state, size, -1)
+        self.since = _grow(self.since, size, 0)
+        self.on_time = _grow(self.on_time, size, 0)
+        self.switches = _grow(self.switches, size, 0)
+        self.false_offs = _grow(self.false_offs, size, 0)
+
+    def fold (self):
+        # add the commands made so far to the totals
+        if len(self.times) == 0:
+            return
+        self.grow()
+        times = numpy.array(self.times, numpy.float64)
+        keys = numpy.array(self.keys, numpy.int64)
+        states = numpy.array(self.states, numpy.int8)
+        self.times = []
+        self.keys = []
+        self.states = []
+
+        # group the commands by key, in time order within each key
+        order = numpy.argsort(keys, kind='mergesort')
+        (times, keys, states) = (times[order], keys[order], states[order])
+
+        # only commands that change the state count. Repeats, say when an
+        #   override ends with the lights already on, don't
+        previous = numpy.empty_like(states)
+        previous[1:] = states[:-1]
+        first = _firsts(keys)
+        previous[first] = self.state[keys[first]]
+        changed = states != previous
+        (times, keys, states, previous) = (times[changed], keys[changed], states[changed],
+                previous[changed])
+        if len(keys) == 0:
+            return
+
+        # how long the state each change ends had lasted
+        started = numpy.empty_like(times)
+        started[1:] = times[:-1]
+        first = _firsts(keys)
+        started[first] = self.since[keys[first]]
+        lasted = times - started
+
+        size = len(self.state)
+        ended_on = previous == 1
+        self.on_time += numpy.bincount(keys[ended_on], weights=lasted[ended_on], minlength=size)
+        # the first command for a key sets its state rather than switching it
+        self.switches += numpy.bincount(keys[previous != -1], minlength=size)
+        regretted = (previous == 0) & (lasted <= occupancy.REGRET_WINDOW)
+        self.false_offs += numpy.bincount(keys[regretted], minlength=size)
+
+        # carry each key's last change over to the next chunk
+        last = numpy.ones(len(keys), bool)
+        last[:-1] = keys[:-1] != keys[1:]
+        self.state[keys[last]] = states[last]
+        self.since[keys[last]] = times[last]
+
+    def finish (self, end):
+        # run the clock up to end and count the time still on until then
+        self.replayer.advance(end)
+        self.fold()
+        self.grow()
+        on = self.state == 1
+        self.on_time[on] += end - self.since[on]
+        self.since[on] = end
+
+    def totals (self):
+        # per room arrays of (on_time, switches, false_offs), each with a
+        #   column per device
+        self.grow()
+        shape = (len(self.rooms.locations), len(DEVICES))
+        return (self.on_time.reshape(shape), self.switches.reshape(shape),
+                self.false_offs.reshape(shape))
+
+def _firsts (keys):
+    # whether each of a sorted array of keys is the first of its run
+    first = numpy.ones(len(keys), bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return first
+
+
+def simulate (events, variants, rooms):
+    # runs events through every variant, returns the time of the last one
+    end = None
+    while True:
+        chunk = list(itertools.islice(events, CHUNK_EVENTS))
+        if len(chunk) == 0:
+            break
+        for variant in variants:
+            variant.replayer.run(chunk)
+            variant.fold()
+        rooms.count_overrides(chunk)
+        end = chunk[-1][0]
+
+    if end is not None:
+        for variant in variants:
+            variant.finish(end)
+    return end
+
+def report (variants, rooms, end):
+    # room-days covered by the events, per room
+    days = numpy.maximum(end - numpy.array(rooms.starts, numpy.float64), 1.0) / 86400
+    print(str(len(rooms.locations)) + " rooms, " + "%.1f" % days.sum() + " room-days, " +
+            "%.2f" % (rooms.overrides.sum() / days.sum()) + " overrides per room-day")
+    print("")
+    print("%-34s %9s %9s %9s %9s %9s" % ("variant (per room-day)", "lights h", "p90 h",
+            "panel h", "switches", "false off"))
+    for variant in variants:
+        (on_time, switches, false_offs) = variant.totals()
+        lights = on_time[:, 0] / 3600 / days
+        print("%-34s %9.2f %9.2f %9.2f %9.2f %9.3f" % (variant.name,
+                on_time[:, 0].sum() / 3600 / days.sum(),
+                numpy.percentile(lights, 90) if len(lights) > 0 else 0,
+                on_time[:, 1].sum() / 3600 / days.sum(),
+                switches.sum() / days.sum(),
+                false_offs[:, 0].sum() / days.sum()))
+
+def write_csv (path, variants, rooms, end):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['location', 'variant', 'days', 'overrides',
+                'lights_hours', 'panel_hours', 'lights_switches', 'panel_switches',
+                'false_offs'])
+        for variant in variants:
+            (on_time, switches, false_offs) = variant.totals()
+            for (number, location) in enumerate(rooms.locations):
+                writer.writerow([location, variant.name,
+                        "%.3f" % ((end - rooms.starts[number]) / 86400.0),
+                        rooms.overrides[number],
+                        "%.3f" % (on_time[number, 0] / 3600),
+                        "%.3f" % (on_time[number, 1] / 3600),
+                        switches[number, 0], switches[number, 1],
+                        false_offs[number, 0]])
+
+def main ():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    synthetic = get_option('synthetic', None)
+    if (len(args) == 0) == (synthetic is None):
+        print(USAGE)
+        sys.exit(1)
+
+    try:
+        absence_timeouts = [None]
+        if get_option('absence', None) is not None:
+            absence_timeouts = [int(value) for value in get_option('absence', None).split(',')]
+        panel_timeouts = [None]
+        if get_option('panel', None) is not None:
+            panel_timeouts = [int(value) for value in get_option('panel', None).split(',')]
+        if synthetic is not None:
+            events = eventlog.synthetic_events(int(synthetic),
+                    float(get_option('days', '7')) * 86400)
+    except ValueError:
+        print(USAGE)
+        sys.exit(1)
+    try:
+        configuration = config.load(get_option('config', None))
+    except config.ConfigError, e:
+        print("Invalid configuration: " + str(e))
+        sys.exit(1)
+    if synthetic is None:
+        events = eventlog.read_inputs(args, configuration.profiles._asdict())
+
+    rooms = Rooms()
+    variants = []
+    for (absence_timeout, panel_timeout) in itertools.product(absence_timeouts, panel_timeouts):
+        for adaptive in ([False, True] if '--adaptive' in sys.argv else [False]):
+            name = ("absence=" + str(absence_timeout or "room") +
+                    " panel=" + str(panel_timeout or "room"))
+            if adaptive:
+                name += " adaptive"
+            variants.append(Variant(name, rooms, absence_timeout=absence_timeout,
+                    panel_timeout=panel_timeout, adaptive=adaptive,
+                    configuration=configuration))
+
+    start = time.time()
+    end = simulate(events, variants, rooms)
+    elapsed = time.time() - start
+    if end is None:
+        print("No events")
+        sys.exit(1)
+
+    report(variants, rooms, end)
+    if get_option('csv', None) is not None:
+        write_csv(get_option('csv', None), variants, rooms, end)
+    print("")
+    print("Simulated " + str(len(variants)) + " variants in " + "%.1f" % elapsed + " seconds")
+
+
+if __name__ == "__main__":
+    main()
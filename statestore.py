@@ -0,0 +1,115 @@
+# Crash-safe room state
+#
+# StateStore keeps the last known state of every room in an append-only file
+#   of json lines, {location: state}, so a restarted controller can carry on
+#   from where it left off: mid-override, mid-absence, and with each device
+#   in the state it was last commanded to.
+#
+# The control loop only hands states to put(). A background thread appends
+#   the changed ones once every SAVE_INTERVAL seconds and fsyncs, so a crash
+#   loses at most that much and never leaves a half written file: a torn last
+#   line is skipped when loading, and the last line for a room wins. Once the
+#   file holds COMPACT_FACTOR lines per room it is rewritten with one line
+#   each, atomically by renaming over the old file.
+
+import os
+import json
+import time
+import threading
+
+import logpipe
+
+log = logpipe.get('state')
+
+
+class StateStore (threading.Thread):
+    # seconds between writes
+    SAVE_INTERVAL = 1.0
+    COMPACT_FACTOR = 10
+
+    def __init__ (self, path):
+        super(StateStore, self).__init__()
+        self.daemon = True
+        self.path = path
+
+        # location: state, as of the last write
+        self.states = {}
+        self.lines = 0
+        # whether the file ends in a line cut off by a crash
+        self.torn = False
+        self._load()
+
+        # location: state waiting to be written
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.start()
+
+    def get (self, location):
+        # the saved state of a room, or None. For use before the first put()
+        return self.states.get(location)
+
+    def put (self, location, state):
+        # queue a room's current state to be saved. Only the latest state of
+        #   each room is kept until the next write
+        with self.cond:
+            self.pending[location] = state
+            self.cond.notify()
+
+    def run (self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                pending = self.pending
+                self.pending = {}
+
+            try:
+                self._append(pending)
+            except (IOError, OSError), e:
+                log.error("Failure to save room state: %s", e)
+            self.states.update(pending)
+
+            if self.lines > self.COMPACT_FACTOR * max(len(self.states), 10):
+                try:
+                    self._compact()
+                except (IOError, OSError), e:
+                    log.error("Failure to compact room state: %s", e)
+
+            # let changes pile up rather than writing after every packet
+            time.sleep(self.SAVE_INTERVAL)
+
+    def _load (self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    self.lines += 1
+                    self.torn = not line.endswith('\n')
+                    try:
+                        self.states.update(json.loads(line))
+                    except (ValueError, TypeError):
+                        # cut off by a crash
+                        continue
+        except IOError:
+            # nothing saved yet
+            pass
+
+    def _append (self, states):
+        with open(self.path, 'a') as f:
+            if self.torn:
+                # finish the cut off line so it doesn't swallow the next one
+                f.write('\n')
+                self.torn = False
+            for (location, state) in states.items():
+                f.write(json.dumps({location: state}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.lines += len(states)
+
+    def _compact (self):
+        with open(self.path + '.tmp', 'w') as f:
+            for (location, state) in self.states.items():
+                f.write(json.dumps({location: state}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + '.tmp', self.path)
+        self.lines = len(self.states)